@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+# Code 128 and QR codes rendered straight to raster lines
+#
+# Symbols are built as module patterns and scaled by whole print head dots
+# (180 dpi), so every bar and module has exactly the same width and there is no
+# PNG decode, dithering or PIL transform in between. The result is the same 1bpp
+# raster read_png returns for an image of the code: image x runs along the tape
+# (one raster line per dot), image y across it, centred in the head.
+#
+# A caption drawn with characters.text_mask can be put under the code.
+
+import functools
+
+import numpy as np
+
+from characters import IMG_STD_HEIGHT, text_mask
+from raster import HEAD_DOTS
+
+CAPTION_GAP = 2
+
+# Code 128 symbols as bar/space widths in modules, by symbol value
+CODE128_PATTERNS = (
+    '212222', '222122', '222221', '121223', '121322', '131222', '122213', '122312', '132212', '221213',
+    '221312', '231212', '112232', '122132', '122231', '113222', '123122', '123221', '223211', '221132',
+    '221231', '213212', '223112', '312131', '311222', '321122', '321221', '312212', '322112', '322211',
+    '212123', '212321', '232121', '111323', '131123', '131321', '112313', '132113', '132311', '211313',
+    '231113', '231311', '112133', '112331', '132131', '113123', '113321', '133121', '313121', '211331',
+    '231131', '213113', '213311', '213131', '311123', '311321', '331121', '312113', '312311', '332111',
+    '314111', '221411', '431111', '111224', '111422', '121124', '121421', '141122', '141221', '112214',
+    '112412', '122114', '122411', '142112', '142211', '241211', '221114', '413111', '241112', '134111',
+    '111242', '121142', '121241', '114212', '124112', '124211', '411212', '421112', '421211', '212141',
+    '214121', '412121', '111143', '111341', '131141', '114113', '114311', '411113', '411311', '113141',
+    '114131', '311141', '411131', '211412', '211214', '211232', '2331112',
+)
+CODE128_CODE_C = 99
+CODE128_CODE_B = 100
+CODE128_START_B = 104
+CODE128_START_C = 105
+CODE128_STOP = 106
+CODE128_QUIET = 10
+
+def _digit_run(text, i):
+    n = i
+    # Only ASCII digits, str.isdigit() also takes other scripts' digits that Code 128 can't encode
+    while n < len(text) and '0' <= text[n] <= '9':
+        n += 1
+    return n - i
+
+def code128_values(text):
+    """ Symbol values of text in Code 128 (code sets B and C), start code to checksum
+
+    Runs of digits go into code set C, two digits a symbol, when that is shorter:
+    four or more digits at either end of the text, six or more in the middle.
+    """
+    if not text:
+        raise ValueError('Code 128 needs at least one character')
+    values = []
+    code = None
+    i = 0
+    while i < len(text):
+        run = _digit_run(text, i)
+        at_end = i + run == len(text)
+        if code != 'C' and (run >= 4 and (i == 0 or at_end) or run >= 6 or run == len(text) == 2):
+            values.append(CODE128_START_C if code is None else CODE128_CODE_C)
+            code = 'C'
+        if code == 'C':
+            if run >= 2:
+                values.append(int(text[i:i + 2]))
+                i += 2
+                continue
+            values.append(CODE128_CODE_B)
+            code = 'B'
+        elif code is None:
+            values.append(CODE128_START_B)
+            code = 'B'
+        c = text[i]
+        if not ' ' <= c <= '\x7f':
+            raise ValueError(f'Code 128 B cannot encode {c!r}')
+        values.append(ord(c) - 32)
+        i += 1
+    values.append((values[0] + sum(i * v for i, v in enumerate(values[1:], 1))) % 103)
+    return values
+
+def code128_modules(text):
+    """ Dark/light modules of text as a bool array, without quiet zones """
+    widths = ''.join(CODE128_PATTERNS[v] for v in code128_values(text) + [CODE128_STOP])
+    # Patterns alternate bar, space, bar... and every one has an even number of elements
+    return np.repeat(np.arange(len(widths)) % 2 == 0, [int(w) for w in widths])
+
+# QR code, byte mode, versions 1 to 10 (up to 57 x 57 modules, more does not fit the head)
+QR_EC_LEVELS = {'L': 1, 'M': 0, 'Q': 3, 'H': 2}
+# Per version and EC level: EC codewords per block, then (blocks, data codewords) groups
+QR_BLOCKS = {
+    1: {'L': (7, (1, 19)), 'M': (10, (1, 16)), 'Q': (13, (1, 13)), 'H': (17, (1, 9))},
+    2: {'L': (10, (1, 34)), 'M': (16, (1, 28)), 'Q': (22, (1, 22)), 'H': (28, (1, 16))},
+    3: {'L': (15, (1, 55)), 'M': (26, (1, 44)), 'Q': (18, (2, 17)), 'H': (22, (2, 13))},
+    4: {'L': (20, (1, 80)), 'M': (18, (2, 32)), 'Q': (26, (2, 24)), 'H': (16, (4, 9))},
+    5: {'L': (26, (1, 108)), 'M': (24, (2, 43)), 'Q': (18, (2, 15), (2, 16)), 'H': (22, (2, 11), (2, 12))},
+    6: {'L': (18, (2, 68)), 'M': (16, (4, 27)), 'Q': (24, (4, 19)), 'H': (28, (4, 15))},
+    7: {'L': (20, (2, 78)), 'M': (18, (4, 31)), 'Q': (18, (2, 14), (4, 15)), 'H': (26, (4, 13), (1, 14))},
+    8: {'L': (24, (2, 97)), 'M': (22, (2, 38), (2, 39)), 'Q': (22, (4, 18), (2, 19)), 'H': (26, (4, 14), (2, 15))},
+    9: {'L': (30, (2, 116)), 'M': (22, (3, 36), (2, 37)), 'Q': (20, (4, 16), (4, 17)), 'H': (24, (4, 12), (4, 13))},
+    10: {'L': (18, (2, 68), (2, 69)), 'M': (26, (4, 43), (1, 44)), 'Q': (24, (6, 19), (2, 20)), 'H': (28, (6, 15), (2, 16))},
+}
+QR_ALIGNMENT = {1: (), 2: (6, 18), 3: (6, 22), 4: (6, 26), 5: (6, 30), 6: (6, 34),
+                7: (6, 22, 38), 8: (6, 24, 42), 9: (6, 26, 46), 10: (6, 28, 50)}
+QR_QUIET = 4
+
+# GF(256) with the QR polynomial x^8 + x^4 + x^3 + x^2 + 1
+_GF_EXP = [0] * 512
+_GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    _GF_EXP[_i] = _x
+    _GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    _GF_EXP[_i] = _GF_EXP[_i - 255]
+
+@functools.lru_cache(maxsize=None)
+def _rs_generator(n):
+    g = [1]
+    for i in range(n):
+        # Multiply by (x - a^i)
+        g = [a ^ (_GF_EXP[_GF_LOG[b] + i] if b else 0) for a, b in zip(g + [0], [0] + g)]
+    return tuple(g)
+
+def _rs_ec(data, n):
+    """ n Reed-Solomon EC codewords of data """
+    g = _rs_generator(n)
+    rem = list(data) + [0] * n
+    for i in range(len(data)):
+        coef = rem[i]
+        if coef:
+            log = _GF_LOG[coef]
+            for j in range(1, n + 1):
+                if g[j]:
+                    rem[i + j] ^= _GF_EXP[log + _GF_LOG[g[j]]]
+    return rem[len(data):]
+
+def _bch(value, poly, bits):
+    """ value followed by its BCH remainder of poly, which has bits + 1 bits """
+    rem = value << bits
+    for shift in range(rem.bit_length() - bits - 1, -1, -1):
+        if rem >> (shift + bits) & 1:
+            rem ^= poly << shift
+    return value << bits | rem
+
+def _qr_capacity(version, ec):
+    _, *groups = QR_BLOCKS[version][ec]
+    return sum(blocks * size for blocks, size in groups)
+
+def _qr_codewords(data, version, ec):
+    """ Data and EC codewords, interleaved in transmission order """
+    count_bits = 8 if version < 10 else 16
+    bits = '0100' + format(len(data), f'0{count_bits}b') + ''.join(format(b, '08b') for b in data)
+    capacity = _qr_capacity(version, ec)
+    bits += '0' * min(4, capacity * 8 - len(bits))
+    bits += '0' * (-len(bits) % 8)
+    codewords = [int(bits[i:i + 8], 2) for i in range(0, len(bits), 8)]
+    codewords += [(0xec, 0x11)[i % 2] for i in range(capacity - len(codewords))]
+
+    ec_size, *groups = QR_BLOCKS[version][ec]
+    blocks = []
+    pos = 0
+    for count, size in groups:
+        for _ in range(count):
+            blocks.append(codewords[pos:pos + size])
+            pos += size
+    ec_blocks = [_rs_ec(block, ec_size) for block in blocks]
+    out = []
+    for i in range(max(len(b) for b in blocks)):
+        out += [b[i] for b in blocks if i < len(b)]
+    for i in range(ec_size):
+        out += [b[i] for b in ec_blocks]
+    return out
+
+_QR_MASKS = (
+    lambda i, j: (i + j) % 2 == 0,
+    lambda i, j: i % 2 == 0,
+    lambda i, j: j % 3 == 0,
+    lambda i, j: (i + j) % 3 == 0,
+    lambda i, j: (i // 2 + j // 3) % 2 == 0,
+    lambda i, j: (i * j) % 2 + (i * j) % 3 == 0,
+    lambda i, j: ((i * j) % 2 + (i * j) % 3) % 2 == 0,
+    lambda i, j: ((i + j) % 2 + (i * j) % 3) % 2 == 0,
+)
+
+def _qr_function_patterns(version):
+    """ Modules of the finder, timing and alignment patterns, and which modules are reserved """
+    n = version * 4 + 17
+    dark = np.zeros((n, n), dtype=bool)
+    reserved = np.zeros((n, n), dtype=bool)
+    finder = np.ones((7, 7), dtype=bool)
+    finder[1:6, 1:6] = False
+    finder[2:5, 2:5] = True
+    for r, c in ((0, 0), (n - 7, 0), (0, n - 7)):
+        dark[r:r + 7, c:c + 7] = finder
+        # Finder plus its light separator
+        reserved[max(r - 1, 0):r + 8, max(c - 1, 0):c + 8] = True
+    align = np.ones((5, 5), dtype=bool)
+    align[1:4, 1:4] = False
+    align[2, 2] = True
+    for r in QR_ALIGNMENT[version]:
+        for c in QR_ALIGNMENT[version]:
+            if reserved[r, c]:
+                continue
+            dark[r - 2:r + 3, c - 2:c + 3] = align
+            reserved[r - 2:r + 3, c - 2:c + 3] = True
+    timing = np.arange(8, n - 8)
+    for i in timing:
+        if not reserved[6, i]:
+            dark[6, i] = dark[i, 6] = i % 2 == 0
+            reserved[6, i] = reserved[i, 6] = True
+    # Format information, and the dark module next to it
+    reserved[8, :9] = reserved[:9, 8] = True
+    reserved[8, n - 8:] = reserved[n - 8:, 8] = True
+    dark[n - 8, 8] = True
+    if version >= 7:
+        reserved[:6, n - 11:n - 8] = reserved[n - 11:n - 8, :6] = True
+        info = _bch(version, 0x1f25, 12)
+        for i in range(18):
+            dark[i // 3, n - 11 + i % 3] = dark[n - 11 + i % 3, i // 3] = info >> i & 1
+    return dark, reserved
+
+def _qr_data_positions(reserved):
+    """ Module coordinates in data placement order: two-column zigzag from the bottom right """
+    n = len(reserved)
+    rows, cols = [], []
+    upward = True
+    col = n - 1
+    while col > 0:
+        if col == 6:
+            # Skip the vertical timing pattern
+            col -= 1
+        for row in (range(n - 1, -1, -1) if upward else range(n)):
+            for c in (col, col - 1):
+                if not reserved[row, c]:
+                    rows.append(row)
+                    cols.append(c)
+        upward = not upward
+        col -= 2
+    return np.array(rows), np.array(cols)
+
+def _qr_format(matrix, ec, mask):
+    n = len(matrix)
+    info = _bch(QR_EC_LEVELS[ec] << 3 | mask, 0x537, 10) ^ 0x5412
+    for i in range(15):
+        bit = info >> i & 1
+        # Down the column next to the top left finder, then the bottom left one
+        if i < 6:
+            matrix[i, 8] = bit
+        elif i < 8:
+            matrix[i + 1, 8] = bit
+        else:
+            matrix[n - 15 + i, 8] = bit
+        # Along the row under the top left and top right finders
+        if i < 8:
+            matrix[8, n - i - 1] = bit
+        elif i < 9:
+            matrix[8, 15 - i] = bit
+        else:
+            matrix[8, 14 - i] = bit
+
+def _qr_penalty(m):
+    penalty = 0
+    for lines in (m, m.T):
+        # Runs of five or more modules of one colour, all lines at once: a one
+        # module separator after every line ends its last run
+        flat = np.concatenate((lines.astype(np.int8), np.full((len(lines), 1), 2, np.int8)), axis=1).ravel()
+        runs = np.diff(np.flatnonzero(np.diff(flat)) + 1, prepend=0)
+        penalty += int(np.sum(runs[runs >= 5] - 2))
+        # Finder-like 1:1:3:1:1 patterns with four light modules on one side
+        width = lines.shape[1] - len(_QR_FINDER_LIKE) + 1
+        for pattern in (_QR_FINDER_LIKE, _QR_FINDER_LIKE[::-1]):
+            match = np.ones((len(lines), width), dtype=bool)
+            for k, dark in enumerate(pattern.tolist()):
+                column = lines[:, k:k + width]
+                match &= column if dark else ~column
+            penalty += 40 * int(match.sum())
+    # 2x2 blocks of one colour
+    block = (m[:-1, :-1] == m[1:, :-1]) & (m[:-1, :-1] == m[:-1, 1:]) & (m[:-1, :-1] == m[1:, 1:])
+    penalty += 3 * int(block.sum())
+    # Balance of dark and light
+    percent = m.sum() * 100 // m.size
+    penalty += 10 * (abs(int(percent) - 50) // 5)
+    return penalty
+
+@functools.lru_cache(maxsize=None)
+def _qr_layout(version):
+    """ Function pattern modules, data module coordinates and the eight masks over them """
+    dark, reserved = _qr_function_patterns(version)
+    rows, cols = _qr_data_positions(reserved)
+    masks = [mask(rows, cols) for mask in _QR_MASKS]
+    dark.flags.writeable = False
+    return dark, rows, cols, masks
+
+_QR_FINDER_LIKE = np.array([1, 0, 1, 1, 1, 0, 1, 0, 0, 0, 0], dtype=bool)
+
+def qr_matrix(data, ec='M', version=None, mask=None):
+    """ QR code modules of data (bytes, or str as UTF-8), True for dark
+
+    The smallest version that fits is used unless given, and the mask with the
+    lowest penalty score unless given.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if ec not in QR_EC_LEVELS:
+        raise ValueError(f'Unknown QR error correction level {ec}')
+    # Mode indicator and character count take 12 bits up to version 9, 20 from 10 on
+    fits = lambda v: _qr_capacity(v, ec) * 8 >= (12 if v < 10 else 20) + len(data) * 8
+    if version is None:
+        version = next((v for v in QR_BLOCKS if fits(v)), None)
+        if version is None:
+            raise ValueError(f'{len(data)} bytes do not fit a version 10 QR code at level {ec}')
+    elif not fits(version):
+        raise ValueError(f'{len(data)} bytes do not fit a version {version} QR code at level {ec}')
+
+    dark, rows, cols, masks = _qr_layout(version)
+    bits = np.unpackbits(np.array(_qr_codewords(data, version, ec), dtype=np.uint8)).astype(bool)
+    # Remainder modules past the last codeword stay light before masking
+    placed = np.zeros(len(rows), dtype=bool)
+    placed[:len(bits)] = bits[:len(rows)]
+
+    candidates = []
+    for k in (range(8) if mask is None else (mask,)):
+        matrix = dark.copy()
+        matrix[rows, cols] = placed ^ masks[k]
+        _qr_format(matrix, ec, k)
+        candidates.append(matrix)
+    if len(candidates) == 1:
+        return candidates[0]
+    return min(candidates, key=_qr_penalty)
+
+def _compose(code, caption, fontfile, fontsize):
+    """ Pack a (lines, dots) code mask, with an optional caption under it, into raster lines """
+    parts = [code]
+    if caption:
+        parts.append(text_mask(caption, fontfile, fontsize))
+    lines = max(p.shape[0] for p in parts)
+    height = sum(p.shape[1] for p in parts) + CAPTION_GAP * (len(parts) - 1)
+    if height > HEAD_DOTS:
+        raise ValueError(f'Code and caption are {height} dots high, the print head has {HEAD_DOTS}')
+    canvas = np.zeros((lines, HEAD_DOTS), dtype=bool)
+    # Centred across the head like read_png pads images, each part centred along the tape
+    y = (HEAD_DOTS - height) // 2
+    for p in parts:
+        x = (lines - p.shape[0]) // 2
+        canvas[x:x + p.shape[0], y:y + p.shape[1]] = p
+        y += p.shape[1] + CAPTION_GAP
+    return np.packbits(canvas, axis=1).tobytes()
+
+def code128(text, module=2, height=None, quiet=CODE128_QUIET, caption=None, fontfile=None, fontsize=16):
+    """ Raster lines of a Code 128 barcode
+
+    module is the narrowest bar in dots, height the bar height in dots (default:
+    what is left of IMG_STD_HEIGHT under the caption). caption=True prints text under it.
+    """
+    if caption is True:
+        caption = text
+    modules = code128_modules(text)
+    bars = np.repeat(np.concatenate((np.zeros(quiet, bool), modules, np.zeros(quiet, bool))), module)
+    if height is None:
+        height = IMG_STD_HEIGHT
+        if caption:
+            height -= text_mask(caption, fontfile, fontsize).shape[1] + CAPTION_GAP
+    if not caption and height <= HEAD_DOTS:
+        # Every raster line is either blank or one full bar, no need for a canvas
+        bar = np.zeros(HEAD_DOTS, dtype=bool)
+        y = (HEAD_DOTS - height) // 2
+        bar[y:y + height] = True
+        blank_line, bar_line = bytes(16), np.packbits(bar).tobytes()
+        return b''.join(bar_line if dark else blank_line for dark in bars.tolist())
+    return _compose(np.repeat(bars[:, None], height, axis=1), caption, fontfile, fontsize)
+
+def qr(data, module=None, ec='M', quiet=QR_QUIET, caption=None, fontfile=None, fontsize=16, max_height=IMG_STD_HEIGHT):
+    """ Raster lines of a QR code
+
+    module is the module size in dots, by default the largest that keeps the code
+    (and caption) within max_height dots. quiet is the quiet zone in modules along
+    the tape, across it the unprinted tape edges already provide one. caption=True
+    prints data under it. Raises ValueError when the code doesn't fit.
+    """
+    if caption is True:
+        caption = data if isinstance(data, str) else data.decode('utf-8', 'replace')
+    matrix = qr_matrix(data, ec)
+    n = len(matrix)
+    room = max_height
+    if caption:
+        room -= text_mask(caption, fontfile, fontsize).shape[1] + CAPTION_GAP
+    if module is None:
+        module = room // n
+    if module < 1 or n * module > room:
+        raise ValueError(f'QR code is {n} modules across, {room} of {max_height} dots are left for it '
+                         f'(module {max(module, 1)} dots), shorten the data or drop the caption')
+    padded = np.zeros((n + 2 * quiet, n), dtype=bool)
+    padded[quiet:quiet + n] = matrix.T
+    # Matrix rows run across the tape: image y is the head dot, image x the raster line
+    code = padded.repeat(module, axis=0).repeat(module, axis=1)
+    return _compose(code, caption, fontfile, fontsize)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# Throughput benchmarks for the label-maker hot paths
+#
+#   ./benchmark.py -s --save baseline.json      record a baseline
+#   ./benchmark.py -s --compare baseline.json   exit 1 on regressions
+#   ./benchmark.py -I                           CLI startup and import time
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+
+from labelmaker_encode import encode_raster_transfer, encode_raster_adaptive, encode_raster_bulk
+
+# 180 dpi print head, one raster line per dot
+LINES_PER_METRE = round(180 / 0.0254)
+
+def synthetic_raster(kind, lines, seed=0):
+    """ Build a 128px wide 1bpp raster (16 bytes per line) for benchmarking
+
+    kind is one of 'blank', 'text' (short bursts of glyph-like lines separated by
+    blank gaps, like a rendered label) or 'noise' (dense random bits).
+    """
+    rng = np.random.default_rng(seed)
+    if kind == 'blank':
+        rows = np.zeros((lines, 16), dtype=np.uint8)
+    elif kind == 'noise':
+        rows = rng.integers(0, 256, size=(lines, 16), dtype=np.uint8)
+    elif kind == 'text':
+        rows = np.zeros((lines, 16), dtype=np.uint8)
+        # 8 dot glyph columns every 12 lines, occupying the middle of the tape
+        glyph_lines = (np.arange(lines) % 12) < 8
+        pattern = rng.integers(0, 256, size=(lines, 8), dtype=np.uint8)
+        rows[glyph_lines, 4:12] = pattern[glyph_lines]
+    else:
+        raise ValueError(f'Unknown raster kind {kind}')
+    return rows.tobytes()
+
+def measure(fn, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def bench_encode(metres, kinds, repeat, nocomp=False):
+    print(f'{"workload":<20}{"lines":>8}{"per-line l/s":>16}{"bulk l/s":>16}{"speedup":>10}'
+          f'{"adaptive l/s":>16}{"bytes":>10}{"adaptive":>10}{"saved":>8}')
+    for kind in kinds:
+        for m in metres:
+            lines = int(m * LINES_PER_METRE)
+            data = synthetic_raster(kind, lines)
+            t_old, old = measure(lambda: b''.join(encode_raster_transfer(data, nocomp)), repeat)
+            t_new, new = measure(lambda: encode_raster_bulk(data, nocomp), repeat)
+            if old != new:
+                raise AssertionError(f'bulk encoder output differs for {kind} @ {m}m')
+            if nocomp:
+                print(f'{f"{kind} {m}m":<20}{lines:>8}{lines / t_old:>16.0f}{lines / t_new:>16.0f}{t_old / t_new:>9.2f}x')
+                continue
+            t_adaptive, adaptive = measure(lambda: b''.join(encode_raster_adaptive(data)), repeat)
+            saved = 1 - len(adaptive) / len(old) if old else 0.0
+            print(f'{f"{kind} {m}m":<20}{lines:>8}{lines / t_old:>16.0f}{lines / t_new:>16.0f}{t_old / t_new:>9.2f}x'
+                  f'{lines / t_adaptive:>16.0f}{len(old):>10}{len(adaptive):>10}{saved:>8.1%}')
+
+# Suite of hot path micro benchmarks, each workload is (name, fn, ops per call).
+# Results are best-of-repeat ops/s plus the memory one call takes under tracemalloc.
+SUITE_LINES = (100, 1000, 10000, 50000)
+SUITE_KINDS = ('blank', 'text', 'noise')
+
+def suite_workloads(font=None, lines=SUITE_LINES, kinds=SUITE_KINDS):
+    import ptcbp
+    import ptstatus
+    from emulator import PrinterEmulator
+
+    for kind in kinds:
+        for n in lines:
+            data = synthetic_raster(kind, n)
+            yield f'encode/{kind}/{n}', lambda data=data: b''.join(encode_raster_transfer(data, False)), n
+
+    line = synthetic_raster('text', 12)[:16]
+    yield 'serialize_control/print', lambda: ptcbp.serialize_control('print'), 1
+    yield 'serialize_control/page_margin', lambda: ptcbp.serialize_control('set_page_margin', 14), 1
+    yield 'serialize_data/rle', lambda: ptcbp.serialize_data(line, 'rle'), 1
+    yield 'serialize_data/none', lambda: ptcbp.serialize_data(line), 1
+
+    frames = ptcbp.serialize_data(line, 'rle') + ptcbp.serialize_control('set_page_margin', 14)
+    def roundtrip():
+        buf = io.BytesIO(frames)
+        op = ptcbp.Opcode.deserialize(buf, 'rle')
+        while op is not None:
+            op.serialize_as_bytes()
+            op = ptcbp.Opcode.deserialize(buf, 'rle')
+    yield 'deserialize/roundtrip', roundtrip, 2
+
+    status = bytes(PrinterEmulator().status())
+    yield 'unpack_status', lambda: ptstatus.unpack_status(status), 1
+
+    import barcode
+    yield 'barcode/code128', lambda: barcode.code128('SN-00012345'), 1
+    yield 'barcode/qr', lambda: barcode.qr('https://example.com/asset/00012345'), 1
+
+    try:
+        from characters import draw_text, draw_text_raster
+        draw_text('Label 0123', fontfile=font)
+    except OSError as e:
+        print(f'** Skipping draw_text workloads: {e}', file=sys.stderr)
+        return
+    yield 'draw_text/horizontal', lambda: draw_text('Label 0123', fontfile=font), 1
+    yield 'draw_text_raster/horizontal', lambda: draw_text_raster('Label 0123', fontfile=font), 1
+    def vertical():
+        # The vertical layout prints its text
+        with contextlib.redirect_stdout(io.StringIO()):
+            return draw_text('Label 0123', fontfile=font, vertical=True)
+    yield 'draw_text/vertical', vertical, 1
+
+def measure_ops(fn, repeat):
+    """ Best calls/s over repeat rounds, each round long enough to time reliably """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return number / min(timer.repeat(repeat=repeat, number=number))
+
+def measure_memory(fn):
+    """ Peak traced bytes during one call and the bytes still allocated after it """
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        result = fn()
+        current, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+    return peak - base, current - base
+
+def run_suite(workloads, repeat):
+    results = {}
+    print(f'{"workload":<32}{"ops/s":>14}{"peak KiB":>12}{"retained B":>12}')
+    for name, fn, ops in workloads:
+        fn()  # Warm up caches (fonts, frame cache)
+        ops_per_sec = measure_ops(fn, repeat) * ops
+        peak, retained = measure_memory(fn)
+        results[name] = {'ops_per_sec': ops_per_sec, 'peak_bytes': peak, 'retained_bytes': retained}
+        print(f'{name:<32}{ops_per_sec:>14.0f}{peak / 1024:>12.1f}{retained:>12}')
+    return results
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results}, f, indent=2)
+        f.write('\n')
+
+def compare_baseline(path, results, threshold):
+    """ Workloads that got slower, or need more peak memory, than the baseline by more than threshold """
+    with open(path) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - threshold):
+            regressions.append(f'{name}: {result["ops_per_sec"]:.0f} ops/s vs {base["ops_per_sec"]:.0f} in the baseline')
+        # Small peaks are dominated by allocator noise
+        if result['peak_bytes'] > max(base['peak_bytes'] * (1 + threshold), base['peak_bytes'] + 4096):
+            regressions.append(f'{name}: peak {result["peak_bytes"]} bytes vs {base["peak_bytes"]} in the baseline')
+    return regressions
+
+# Modules a CLI run may import, and the heavy dependencies to watch for
+STARTUP_MODULES = ('labelmaker', 'ptstatus', 'spool', 'render_cache')
+HEAVY_MODULES = ('numpy', 'PIL', 'curses', 'bluetooth', 'serial', 'characters', 'raster')
+
+def import_time(module):
+    """ Cumulative import time of module in a fresh interpreter (seconds), and the heavy modules it pulled in """
+    code = f'import sys, {module}; print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6, proc.stdout.strip()
+    raise AssertionError(f'no import time reported for {module}')
+
+def run_time(argv):
+    """ Wall time of one fresh interpreter running argv """
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + argv, stdout=subprocess.DEVNULL, check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    return time.perf_counter() - start
+
+def bench_startup(repeat):
+    """ Import time of the CLI modules and wall time of typical short CLI runs, best of repeat """
+    print(f'{"module":<32}{"import ms":>10}  heavy imports')
+    for module in STARTUP_MODULES:
+        seconds, heavy = min(import_time(module) for _ in range(repeat))
+        print(f'{module:<32}{seconds * 1000:>10.1f}  {heavy or "-"}')
+
+    from PIL import Image
+    with tempfile.TemporaryDirectory() as tmp:
+        image = os.path.join(tmp, 'label.png')
+        Image.new('L', (400, 64), 255).save(image)
+        cache = os.path.join(tmp, 'cache')
+        dry_run = ['labelmaker.py', '-i', image, '--cache-dir', cache, '--dry-run']
+        runs = {
+            'python -c pass': ['-c', 'pass'],
+            'labelmaker.py --help': ['labelmaker.py', '--help'],
+            'labelmaker.py cached dry run': dry_run,
+        }
+        # Fill the cache so the timed dry runs are hits
+        run_time(dry_run)
+        print(f'{"command":<32}{"wall ms":>10}')
+        for name, argv in runs.items():
+            seconds = min(run_time(argv) for _ in range(repeat))
+            print(f'{name:<32}{seconds * 1000:>10.1f}')
+
+def bench_job(metres, kinds, bandwidth, head_speed, time_scale, nocomp=False, mtu=None, flush_lines=None):
+    """ End-to-end do_print_job throughput against the printer emulator """
+    import labelmaker
+    import transport
+    from emulator import PrinterEmulator
+
+    mtu = mtu or transport.DEFAULT_MTU
+    job_args = argparse.Namespace(no_feed=False, auto_cut=False, end_margin=0, nocomp=nocomp, no_print=False, adaptive=False,
+                                  mtu=mtu, flush_bytes=mtu, flush_lines=flush_lines, flush_at_end=False)
+    print(f'{"job":<20}{"lines":>8}{"bytes":>10}{"writes":>8}{"wall s":>10}{"simulated s":>13}{"l/s":>10}')
+    for kind in kinds:
+        for m in metres:
+            lines = int(m * LINES_PER_METRE)
+            data = synthetic_raster(kind, lines)
+            ser = PrinterEmulator(bandwidth=bandwidth, head_speed=head_speed, time_scale=time_scale)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                labelmaker.do_print_job(ser, job_args, data)
+            wall = time.perf_counter() - start
+            if b''.join(ser.pages[-1]) != data:
+                raise AssertionError(f'emulator printed a different image for {kind} @ {m}m')
+            print(f'{f"{kind} {m}m":<20}{lines:>8}{ser.bytes_received:>10}{ser.writes:>8}{wall:>10.3f}{ser.elapsed:>13.3f}{lines / wall:>10.0f}')
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Benchmark raster encoding throughput.')
+    p.add_argument('-m', '--metres', help='Label lengths to encode, in metres.', nargs='+', type=float, default=[1, 2, 5])
+    p.add_argument('-k', '--kinds', help='Synthetic image kinds.', nargs='+', default=['blank', 'text', 'noise'])
+    p.add_argument('-r', '--repeat', help='Repetitions per workload (best time is reported).', type=int, default=3)
+    p.add_argument('-C', '--nocomp', help='Benchmark the uncompressed encoder.', action='store_true')
+    p.add_argument('-j', '--job', help='Benchmark whole print jobs against the printer emulator instead.', action='store_true')
+    p.add_argument('--bandwidth', help='Emulated link speed in bytes/s (job benchmark).', type=float)
+    p.add_argument('--head-speed', help='Emulated print speed in lines/s (job benchmark).', type=float)
+    p.add_argument('--time-scale', help='Fraction of the emulated delays actually slept (job benchmark).', type=float, default=0.0)
+    p.add_argument('--mtu', help='Transport write size (job benchmark).', type=int)
+    p.add_argument('--flush-lines', help='Flush the send buffer every N raster lines (job benchmark).', type=int)
+    p.add_argument('-I', '--imports', help='Benchmark CLI startup: module import time and short runs in fresh interpreters.', action='store_true')
+    p.add_argument('-s', '--suite', help='Run the hot path suite (encode, serialize, deserialize, unpack_status, draw_text).', action='store_true')
+    p.add_argument('--lines', help='Raster lengths for the suite encode workloads.', nargs='+', type=int, default=list(SUITE_LINES))
+    p.add_argument('--font', help='Font file for the draw_text workloads (default: the draw_text default).')
+    p.add_argument('--save', help='Save the suite results as a JSON baseline.')
+    p.add_argument('--compare', help='Compare the suite results against a JSON baseline and fail on regressions.')
+    p.add_argument('--threshold', help='Allowed slowdown or peak memory growth against the baseline, as a fraction.', type=float, default=0.25)
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    if args.suite:
+        results = run_suite(suite_workloads(args.font, args.lines, args.kinds), args.repeat)
+        if args.save:
+            save_baseline(args.save, results)
+        if args.compare:
+            regressions = compare_baseline(args.compare, results, args.threshold)
+            for regression in regressions:
+                print(f'** Regression: {regression}')
+            if regressions:
+                sys.exit(1)
+    elif args.imports:
+        bench_startup(args.repeat)
+    elif args.job:
+        bench_job(args.metres, args.kinds, args.bandwidth, args.head_speed, args.time_scale, args.nocomp, args.mtu, args.flush_lines)
+    else:
+        bench_encode(args.metres, args.kinds, args.repeat, args.nocomp)
+
+if __name__ == '__main__':
+    main()
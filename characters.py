@@ -4,25 +4,82 @@ from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 from PIL import ImageOps
+import functools
+import numpy as np
 import sys
 import os
 
+FONT_CACHE_SIZE = 64
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(fontfile, fontsize):
+    return ImageFont.truetype(fontfile, fontsize)
+
+# Shared measurement context, text is never drawn on it
+_measure_draw = ImageDraw.Draw(Image.new('1', (1, 1)))
+
 def getSize(txt, font):
-    testImg = Image.new('1', (1, 1))
-    testDraw = ImageDraw.Draw(testImg)
-    return testDraw.textsize(txt, font)
+    if hasattr(_measure_draw, 'textsize'):
+        return _measure_draw.textsize(txt, font)
+    # Pillow >= 10 dropped textsize(), its bbox ends at the same point
+    _, _, right, bottom = _measure_draw.textbbox((0, 0), txt, font)
+    return right, bottom
 
 
 MARGIN_H = 0
 MARGIN_V = 0
 LABEL_C_MODE_MERGIN = 20
 IMG_STD_HEIGHT = 64
+MIN_AUTO_FONTSIZE = 10
+
+# Fitted font sizes per (text length class, font, tape width), see draw_text(cache_fit=True)
+_fit_cache = {}
+
+def fit_font_size(text, fontfile, max_height=IMG_STD_HEIGHT - MARGIN_V):
+    """ Smallest font size (from MIN_AUTO_FONTSIZE up) whose text height reaches max_height
+
+    Same result as stepping the size up one by one, assuming height grows with size,
+    but found by doubling then bisecting so only O(log n) fonts get loaded.
+    """
+    height = lambda size: getSize(text, load_font(fontfile, size))[1]
+    lo = MIN_AUTO_FONTSIZE
+    if height(lo) >= max_height:
+        return lo
+    hi = lo * 2
+    while height(hi) < max_height:
+        lo, hi = hi, hi * 2
+    # height(lo) < max_height <= height(hi)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if height(mid) >= max_height:
+            hi = mid
+        else:
+            lo = mid
+    return hi
 
 
-def draw_text(text, fontfile = None, vertical = None, fontsize = 0, tape_width = 12):
+DEFAULT_FONT = "/usr/share/fonts/truetype/ubuntu/UbuntuMono-R.ttf"
+
+def _font_size(text, fontfile, fontsize, tape_width, cache_fit):
+    if not fontsize:
+        key = (len(text).bit_length(), fontfile, tape_width)
+        fontsize = _fit_cache.get(key) if cache_fit else None
+        if fontsize is None:
+            fontsize = fit_font_size(text, fontfile)
+            if cache_fit:
+                _fit_cache[key] = fontsize
+    return fontsize
+
+def draw_text(text, fontfile = None, vertical = None, fontsize = 0, tape_width = 12, cache_fit = False):
+    """ Render text as a 128px wide, mirrored label image
+
+    With cache_fit, an auto-fitted font size is reused for texts of the same length
+    class, font and tape width instead of being searched for again. Glyphs with
+    descenders can make the exact fit differ by a size, so it is opt-in.
+    """
     if not fontfile:
         #fontfile = os.path.join(os.path.dirname(__file__), 'yahei.ttf')
-        fontfile = "/usr/share/fonts/truetype/ubuntu/UbuntuMono-R.ttf"
+        fontfile = DEFAULT_FONT
 
     ## Only tested with 12mm tape
     ## todo: support the other width
@@ -32,7 +89,7 @@ def draw_text(text, fontfile = None, vertical = None, fontsize = 0, tape_width =
         if not fontsize:
             fontsize = 10
 
-        font = ImageFont.truetype(fontfile, fontsize)
+        font = load_font(fontfile, fontsize)
 
         total_length = 0
         for item in text.split(" "):
@@ -65,16 +122,9 @@ def draw_text(text, fontfile = None, vertical = None, fontsize = 0, tape_width =
 
 
     else:
-        if not fontsize:
-            fontsize = 10
-            height = 10
-            while height < IMG_STD_HEIGHT - MARGIN_V :
-                font = ImageFont.truetype(fontfile, fontsize)
-                width, height = getSize(text, font)
-                fontsize  = fontsize + 1
-        else:
-            font = ImageFont.truetype(fontfile, fontsize)
-            width, height = getSize(text, font)
+        fontsize = _font_size(text, fontfile, fontsize, tape_width, cache_fit)
+        font = load_font(fontfile, fontsize)
+        width, height = getSize(text, font)
 
         img_width = width + MARGIN_H
         img_height = height + MARGIN_V
@@ -94,3 +144,115 @@ def draw_text(text, fontfile = None, vertical = None, fontsize = 0, tape_width =
 
     return img
 
+
+# Glyph atlas
+# For monospace fonts without kerning, a horizontal label is just every glyph drawn
+# at a multiple of the advance, and the final raster (after rotate -90, pad, mirror)
+# is the transpose of that image shifted into the 128-dot head. Glyph bitmaps are
+# rendered once per (font, size) and ORed straight into the transposed raster.
+ATLAS_CHARS = ''.join(chr(c) for c in range(0x20, 0x7f))
+ATLAS_CACHE_SIZE = 16
+HEAD_DOTS = 128
+
+class GlyphAtlas(object):
+    def __init__(self, font):
+        self.font = font
+        self.advance = int(font.getlength(ATLAS_CHARS[0]))
+        # Room for glyphs reaching left of their pen position or below the line
+        self.pad = font.size
+        height = font.size * 3
+        self.glyphs = {}
+        for c in ATLAS_CHARS:
+            cell = Image.new('1', (self.advance + 2 * self.pad, height), 'black')
+            ImageDraw.Draw(cell).text((self.pad, 0), c, font=font, fill='white')
+            # Stored transposed: rows are raster lines, columns are head dots
+            self.glyphs[c] = np.ascontiguousarray(np.asarray(cell, dtype=bool).T)
+
+    @staticmethod
+    def usable(font):
+        """ Whether every atlas glyph has the same integer advance and pairs do not kern """
+        advances = {font.getlength(c) for c in ATLAS_CHARS}
+        if len(advances) != 1:
+            return False
+        advance = advances.pop()
+        return advance == int(advance) and advance > 0 and font.getlength('AVTo') == 4 * advance
+
+    def render(self, text, width, height):
+        """ The raster of draw_text(text) for a text image of width x height, as 1bpp bytes """
+        lines = np.zeros((width, HEAD_DOTS), dtype=bool)
+        # Same centring as the pad step, mirrored
+        offset = HEAD_DOTS - height - (HEAD_DOTS - height) // 2
+        self.compose(text, width, height, lines[:, offset:offset + height])
+        return np.packbits(lines, axis=1).tobytes()
+
+    def compose(self, text, width, height, dest=None):
+        """ OR the transposed text image into dest, a (width, height) bool array """
+        if dest is None:
+            dest = np.zeros((width, height), dtype=bool)
+        for i, c in enumerate(text):
+            cell = self.glyphs[c]
+            top = i * self.advance - self.pad
+            src0, dst0 = max(0, -top), max(0, top)
+            n = min(cell.shape[0] - src0, width - dst0)
+            if n > 0:
+                dest[dst0:dst0 + n] |= cell[src0:src0 + n, :height]
+        return dest
+
+_PROBE_TEXT = ATLAS_CHARS + ' gjpqy|_ Wq'
+
+@functools.lru_cache(maxsize=ATLAS_CACHE_SIZE)
+def load_atlas(fontfile, fontsize):
+    """ GlyphAtlas for the font, or None if it cannot reproduce the PIL output """
+    font = load_font(fontfile, fontsize)
+    if MARGIN_H or MARGIN_V or not GlyphAtlas.usable(font):
+        return None
+    atlas = GlyphAtlas(font)
+    # Check a string with every glyph against the PIL path once
+    width, height = getSize(_PROBE_TEXT, font)
+    if height > HEAD_DOTS or atlas.render(_PROBE_TEXT, width, height) != _draw_text_pil_raster(_PROBE_TEXT, font):
+        return None
+    return atlas
+
+def _draw_text_pil_raster(text, font):
+    width, height = getSize(text, font)
+    img = Image.new("1", (width, height), 'black')
+    ImageDraw.Draw(img).text((0, 0), text, font = font, fill = 'white')
+    img = img.rotate(-90, expand=True)
+    padded = Image.new('1', (HEAD_DOTS, width))
+    padded.paste(img, ((HEAD_DOTS - height) // 2, 0, (HEAD_DOTS - height) // 2 + height, width))
+    return ImageOps.mirror(padded).tobytes()
+
+def _atlas_text(text):
+    return bool(text) and all(' ' <= c <= '~' for c in text)
+
+def text_mask(text, fontfile = None, fontsize = 30):
+    """ Boolean (length, height) array of the text drawn as draw_text does horizontally, transposed
+
+    Rows run along the tape and columns across it, like raster lines. Uses the
+    glyph atlas when it can.
+    """
+    fontfile = fontfile or DEFAULT_FONT
+    font = load_font(fontfile, fontsize)
+    width, height = getSize(text, font)
+    atlas = load_atlas(fontfile, fontsize) if _atlas_text(text) else None
+    if atlas is not None:
+        return atlas.compose(text, width, height)
+    img = Image.new("1", (width, height), 'black')
+    ImageDraw.Draw(img).text((0, 0), text, font = font, fill = 'white')
+    return np.asarray(img, dtype=bool).T
+
+def draw_text_raster(text, fontfile = None, fontsize = 0, tape_width = 12, cache_fit = False):
+    """ The 1bpp raster of a horizontal label, i.e. draw_text(...).tobytes()
+
+    Printable ASCII in a monospace font is composed from the glyph atlas, anything
+    else goes through draw_text.
+    """
+    fontfile = fontfile or DEFAULT_FONT
+    if _atlas_text(text):
+        fontsize = _font_size(text, fontfile, fontsize, tape_width, cache_fit)
+        atlas = load_atlas(fontfile, fontsize)
+        if atlas is not None:
+            width, height = getSize(text, atlas.font)
+            if height <= HEAD_DOTS:
+                return atlas.render(text, width, height)
+    return draw_text(text, fontfile, False, fontsize, tape_width, cache_fit).tobytes()
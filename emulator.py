@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# In-process PT-P300BT emulator
+#
+# Parses the PTCBP stream it is sent, keeps the raster lines of every printed page
+# and answers like the real printer does: a status reply for get_status, then phase
+# change / printing completed / phase change frames after a print command.
+# Link bandwidth and print head speed are simulated by delaying sends and replies.
+
+import io
+import socket
+import threading
+import time
+
+import ptcbp
+import ptstatus
+from transport import Transport
+
+STATUS_MAGIC = b'\x80\x20B0'
+
+class PrinterEmulator(Transport):
+    def __init__(self, model=0x72, tape_width=12, tape_type=0x01, power=4,
+                 bandwidth=None, head_speed=None, time_scale=1.0, timeout=None) -> None:
+        """
+        bandwidth: simulated link speed in bytes/s (None for unlimited)
+        head_speed: simulated print speed in raster lines/s (None for instant)
+        time_scale: multiplier applied to every simulated delay (0 disables sleeping
+                    while still accounting the simulated time in self.elapsed)
+        timeout: seconds recv() waits for a reply before raising socket.timeout
+        """
+        self.model = int(model)
+        self.tape_width = int(tape_width)
+        self.tape_type = int(tape_type)
+        self.power = int(power)
+        self.bandwidth = bandwidth
+        self.head_speed = head_speed
+        self.time_scale = time_scale
+        self.timeout = timeout
+
+        self.err = 0
+        self.elapsed = 0.0
+        self.bytes_received = 0
+        self.writes = 0
+        self.pages = []
+        self.opcodes = []
+
+        self._rx = bytearray()
+        self._tx = []
+        self._tx_ready = threading.Condition()
+        self._closed = False
+        self._busy_until = 0.0
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        self.compression = 'none'
+        self.print_parameters = None
+        self.page_mode = 0
+        self.page_mode_advanced = 0
+        self.page_margin = 0
+        self.lines = []
+
+    def _delay(self, seconds: float) -> None:
+        self.elapsed += seconds
+        if self.time_scale:
+            time.sleep(seconds * self.time_scale)
+
+    def status(self, status_type=0x00, phase_type=0x00, phase=0x0000, notification=0x00) -> ptstatus.StatusRegister:
+        stat = ptstatus.StatusRegister()
+        stat.magic = STATUS_MAGIC
+        stat.model = self.model
+        stat.country = 0x30
+        stat._power = self.power
+        stat.err = self.err
+        stat.tape_width = self.tape_width
+        stat.tape_type = self.tape_type
+        stat.mode = self.page_mode
+        stat.status_type = status_type
+        stat.phase_type = phase_type
+        stat.phase = phase
+        stat.notification = notification
+        stat.tape_bgcolor = 0x01
+        stat.tape_fgcolor = 0x08
+        return stat
+
+    def _reply(self, stat: ptstatus.StatusRegister, delay: float=0.0) -> None:
+        due = max(time.monotonic(), self._busy_until) + delay * self.time_scale
+        with self._tx_ready:
+            self._tx.append([due, bytes(stat)])
+            self._tx_ready.notify_all()
+
+    def set_error(self, err: int) -> None:
+        """ Raise error flags (ERR_FLAGS bits), or clear them with 0, and notify the host """
+        self.err = err
+        self._reply(self.status(status_type=0x02 if err else 0x06))
+
+    def _print(self) -> None:
+        self.pages.append(self.lines)
+        head_time = len(self.lines) / self.head_speed if self.head_speed else 0.0
+        self._reply(self.status(status_type=0x06, phase_type=0x01))
+        self._reply(self.status(status_type=0x01), head_time)
+        self._reply(self.status(status_type=0x06), head_time)
+        self.elapsed += head_time
+        self._busy_until = max(time.monotonic(), self._busy_until) + head_time * self.time_scale
+        self.lines = []
+
+    def _execute(self, opcode: ptcbp.Opcode) -> None:
+        mnemonic = opcode.op_mnemonic
+        self.opcodes.append(mnemonic)
+        if mnemonic == 'reset':
+            self._reset_state()
+        elif mnemonic == 'get_status':
+            self._reply(self.status())
+        elif mnemonic == 'set_print_parameters':
+            self.print_parameters = ptcbp.PrintParameters(*opcode.params)
+        elif mnemonic == 'set_page_mode':
+            self.page_mode = opcode.params[0]
+        elif mnemonic == 'set_page_mode_advanced':
+            self.page_mode_advanced = opcode.params[0]
+        elif mnemonic == 'set_page_margin':
+            self.page_margin = opcode.params[0]
+        elif mnemonic == 'compression':
+            self.compression = ptcbp.COMPRESSIONS[opcode.params[0]][0]
+        elif mnemonic in ('data', 'data2'):
+            self.lines.append(opcode.data.getvalue_raw())
+        elif mnemonic == 'zerofill':
+            self.lines.append(bytes(16))
+        elif mnemonic in ('print', 'print_page'):
+            self._print()
+
+    def send(self, data: bytes) -> int:
+        self.writes += 1
+        self.bytes_received += len(data)
+        if self.bandwidth:
+            self._delay(len(data) / self.bandwidth)
+        self._rx += data
+        buf = io.BytesIO(self._rx)
+        while True:
+            start = buf.tell()
+            try:
+                opcode = ptcbp.Opcode.deserialize(buf, self.compression)
+            except IOError:
+                # Incomplete opcode, wait for the rest of it
+                buf.seek(start)
+                break
+            if opcode is None:
+                break
+            self._execute(opcode)
+        del self._rx[:buf.tell()]
+        return len(data)
+
+    def close(self) -> None:
+        with self._tx_ready:
+            self._closed = True
+            self._tx_ready.notify_all()
+
+    def recv(self, size: int) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._tx_ready:
+            while True:
+                now = time.monotonic()
+                if self._closed:
+                    # Same as a socket closed by the peer
+                    return b''
+                if self._tx and self._tx[0][0] <= now:
+                    break
+                if deadline is not None and now >= deadline:
+                    raise socket.timeout('timed out')
+                wait = [t for t in (self._tx[0][0] if self._tx else None, deadline) if t is not None]
+                self._tx_ready.wait(min(wait) - now if wait else None)
+            head = self._tx[0]
+            out, head[1] = head[1][:size], head[1][size:]
+            if not head[1]:
+                self._tx.pop(0)
+            return out
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Printer fleet dispatcher
+#
+# Drives every printer of the [fleet] section in config.ini through its own
+# AsyncPrinter, so all of them print at the same time. A job goes to the
+# least-loaded printer whose loaded tape matches it, judged from the status frames
+# each printer keeps sending. A printer that reports an error mid-job is taken out
+# of rotation until it reports ready again, and its jobs move to the others.
+#
+#   [fleet]
+#   desk = rfcomm://EC:79:xx:xx:xx:01
+#   shop = tcp://192.168.1.20
+
+import argparse
+import asyncio
+import configparser
+import contextlib
+import os
+import time
+
+import transport
+from labelmaker import read_batch, render_job
+from labelmaker_async import AsyncPrinter, PrinterError, describe_status
+
+# ptstatus.POWER
+POWER_AC = 4
+POWER_CRITICAL = 3
+
+DEFAULT_RETRY_INTERVAL = 10.0
+DEFAULT_MAX_ATTEMPTS = 3
+# Refresh the status of idle printers this often, so tape swaps and battery drain are noticed
+DEFAULT_IDLE_POLL = 30.0
+
+class FleetJob(object):
+    def __init__(self, data, tape_width=None, tape_type=None, name=None):
+        """ data is the 1bpp raster, tape_width/tape_type restrict the printers it may go to """
+        self.data = data
+        self.lines = len(data) // 16
+        self.tape_width = tape_width
+        self.tape_type = tape_type
+        self.name = name
+        self.failed_on = set()
+        self.future = None
+
+class FleetPrinter(object):
+    def __init__(self, name, spec, mtu=transport.DEFAULT_MTU):
+        """ spec is a transport spec, or a Transport object to use as is """
+        self.name = name
+        self.spec = spec
+        self.mtu = mtu
+        self.printer = None
+        # Created by Fleet.open(), before Python 3.10 an asyncio.Queue binds to the loop current at construction
+        self.queue = None
+        self.available = False
+        self.error = None
+        # Raster lines of the jobs queued on or printing on this printer
+        self.backlog = 0
+        self.jobs_done = 0
+        self.lines_done = 0
+
+    @property
+    def status(self):
+        return self.printer.status if self.printer is not None else None
+
+    async def connect(self):
+        if self.printer is not None:
+            await self.printer.close()
+        conn = transport.open_transport(self.spec) if isinstance(self.spec, str) else self.spec
+        self.printer = AsyncPrinter(conn, mtu=self.mtu, name=self.name)
+        await self.printer.open()
+
+    def ready(self, status):
+        return status.err == 0x0000 and status.phase_type == 0x00 and status.phase == 0x0000
+
+    def compatible(self, job):
+        status = self.status
+        if not self.available or status is None or job is not None and self.name in job.failed_on:
+            return False
+        if job is not None and job.tape_width is not None and status.tape_width != job.tape_width:
+            return False
+        if job is not None and job.tape_type is not None and status.tape_type != job.tape_type:
+            return False
+        return status._power != POWER_CRITICAL
+
+    def load(self):
+        """ Routing key, lower is better: backlog, then idle before busy, then AC before fuller battery """
+        status = self.status
+        busy = status.phase_type != 0x00
+        power = -1 if status._power == POWER_AC else status._power
+        return (self.backlog, busy, power)
+
+    def describe(self):
+        status = self.status
+        state = 'up' if self.available else f'down ({self.error})'
+        tape = f'{status.tape_width}mm' if status is not None else '?'
+        return f'{self.name}: {state}, tape {tape}, {self.backlog} lines queued, {self.jobs_done} jobs / {self.lines_done} lines done'
+
+class Fleet(object):
+    def __init__(self, printers, compress=True, retry_interval=DEFAULT_RETRY_INTERVAL,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, idle_poll=DEFAULT_IDLE_POLL, on_event=None):
+        """ printers is a list of FleetPrinter """
+        self.printers = printers
+        self.compress = compress
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.idle_poll = idle_poll
+        self.on_event = on_event or (lambda message: None)
+        self._tasks = []
+
+    async def open(self):
+        for p in self.printers:
+            p.queue = asyncio.Queue()
+        await asyncio.gather(*(self._bring_up(p) for p in self.printers))
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker(p)) for p in self.printers]
+        return self
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        for p in self.printers:
+            if p.printer is not None:
+                with contextlib.suppress(OSError):
+                    await p.printer.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _bring_up(self, p):
+        try:
+            if p.printer is None or p.printer.closed:
+                await p.connect()
+            status = await p.printer.recover()
+        except (OSError, PrinterError, asyncio.TimeoutError) as e:
+            p.available, p.error = False, str(e) or type(e).__name__
+            self.on_event(f'[{p.name}] unavailable: {p.error}')
+            return False
+        if not p.ready(status):
+            p.available, p.error = False, describe_status(status)
+            self.on_event(f'[{p.name}] not ready: {p.error}')
+            return False
+        if not p.available:
+            self.on_event(f'[{p.name}] ready, {status.tape_width}mm tape')
+        p.available, p.error = True, None
+        return True
+
+    def submit(self, job):
+        """ Queue job on the best printer for it. Returns a future of (printer name, completion status). """
+        if job.future is None:
+            job.future = asyncio.get_running_loop().create_future()
+        candidates = [p for p in self.printers if p.compatible(job)]
+        if not candidates:
+            raise PrinterError(f'No available printer for {job.name or "job"} '
+                               f'(tape {job.tape_width or "any"}mm, tried {sorted(job.failed_on) or "none"})')
+        p = min(candidates, key=FleetPrinter.load)
+        p.backlog += job.lines
+        p.queue.put_nowait(job)
+        return job.future
+
+    def _reroute(self, job, error):
+        if len(job.failed_on) >= self.max_attempts:
+            job.future.set_exception(error)
+            return
+        try:
+            self.submit(job)
+        except PrinterError as e:
+            job.future.set_exception(e)
+
+    async def _next_job(self, p):
+        while True:
+            try:
+                return await asyncio.wait_for(p.queue.get(), self.idle_poll)
+            except asyncio.TimeoutError:
+                if p.available:
+                    await self._bring_up(p)
+
+    async def _worker(self, p):
+        while True:
+            if not p.available:
+                # Hand everything queued here to the other printers, then wait for recovery
+                while not p.queue.empty():
+                    job = p.queue.get_nowait()
+                    p.backlog -= job.lines
+                    self._reroute(job, PrinterError(f'{p.name} is unavailable'))
+                await asyncio.sleep(self.retry_interval)
+                await self._bring_up(p)
+                continue
+
+            job = await self._next_job(p)
+            if not p.available:
+                p.queue.put_nowait(job)
+                continue
+            try:
+                status = await p.printer.print(job.data, compress=self.compress)
+            except (OSError, PrinterError, asyncio.TimeoutError) as e:
+                p.available, p.error = False, str(e) or type(e).__name__
+                job.failed_on.add(p.name)
+                self.on_event(f'[{p.name}] failed {job.name or "job"}: {e}, failing over')
+                self._reroute(job, e)
+            else:
+                p.jobs_done += 1
+                p.lines_done += job.lines
+                if not job.future.done():
+                    job.future.set_result((p.name, status))
+            finally:
+                p.backlog -= job.lines
+
+    async def print_all(self, jobs):
+        """ Print every FleetJob, returns a list of (printer name, status) or exceptions in input order """
+        futures = []
+        for job in jobs:
+            try:
+                futures.append(self.submit(job))
+            except PrinterError as e:
+                futures.append(asyncio.get_running_loop().create_future())
+                futures[-1].set_exception(e)
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+def load_fleet(conf, mtu=transport.DEFAULT_MTU):
+    """ FleetPrinters from the [fleet] section, one name = transport spec per line """
+    if not conf.has_section('fleet'):
+        return []
+    return [FleetPrinter(name, spec, mtu) for name, spec in conf.items('fleet')]
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Print a batch of labels across several printers.')
+    p.add_argument('-b', '--batch', help="CSV or JSON lines file with the labels ('-' for stdin). A 'tape_width' column restricts a label to printers with that tape.")
+    p.add_argument('-i', '--image', help='Image file to print, can be repeated.', action='append', default=[])
+    p.add_argument('-p', '--printer', help='NAME=SPEC, replaces the [fleet] section of config.ini. Can be repeated.', action='append')
+    p.add_argument('-C', '--nocomp', help='Disable compression.', action='store_true')
+    p.add_argument('--max-attempts', help='Printers a job may fail on before it is given up.', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    p.add_argument('--retry-interval', help='Seconds between attempts to bring a failed printer back.', type=float, default=DEFAULT_RETRY_INTERVAL)
+    return p.parse_args()
+
+async def run(printers, jobs, args):
+    async with Fleet(printers, compress=not args.nocomp, retry_interval=args.retry_interval,
+                     max_attempts=args.max_attempts, on_event=print) as fleet:
+        start = time.perf_counter()
+        results = await fleet.print_all(jobs)
+        elapsed = time.perf_counter() - start
+        failed = 0
+        for job, result in zip(jobs, results):
+            if isinstance(result, Exception):
+                failed += 1
+                print(f'** {job.name}: {result}')
+        lines = sum(p.lines_done for p in printers)
+        print(f'=> {len(jobs) - failed}/{len(jobs)} labels, {lines} lines in {elapsed:.2f}s ({lines / elapsed:.0f} lines/s)')
+        for p in printers:
+            print(f'   {p.describe()}')
+        return failed
+
+def main():
+    args = parse_args()
+    conf = configparser.ConfigParser()
+    conf.read(os.path.join(os.path.dirname(__file__), "config.ini"))
+    if args.printer:
+        printers = [FleetPrinter(*item.split('=', 1)) for item in args.printer]
+    else:
+        printers = load_fleet(conf)
+    if not printers:
+        print('** No printers, add a [fleet] section to config.ini or use -p.')
+        raise SystemExit(1)
+
+    tape_width = conf.getint('printer', 'tape_width', fallback=12)
+    batch = read_batch(args.batch) if args.batch else []
+    batch += [{'image': path} for path in args.image]
+    jobs = []
+    for i, item in enumerate(batch):
+        width = int(item['tape_width']) if item.get('tape_width') else None
+        data, _ = render_job(item, width or tape_width, nocomp=args.nocomp)
+        jobs.append(FleetJob(data, tape_width=width, name=item.get('label') or item.get('image') or f'#{i}'))
+
+    raise SystemExit(1 if asyncio.run(run(printers, jobs, args)) else 0)
+
+if __name__ == '__main__':
+    main()
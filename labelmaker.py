@@ -1,34 +1,59 @@
 #!/usr/bin/env python3
 
-from labelmaker_encode import encode_raster_transfer, read_png
-from characters import draw_text
+# Startup cost matters, scripts run this once per label. PIL, numpy, curses,
+# characters and raster are imported where they are used, so e.g. a render
+# cache hit or a dry run never loads what it does not need.
+from labelmaker_encode import DITHERS, blank_runs, encode_raster_transfer, encode_raster_adaptive, encode_raster_bulk, encode_raster_lines, raster_line_count, read_png, read_png_lines
 import argparse
-import bluetooth
 import sys
 import contextlib
-import ctypes
+import metrics
 import ptcbp
 import ptstatus
-import curses
-from PIL import ImageOps
-import configparser
+import render_cache
+import transport
+import csv
+import json
 import os
 
-BARS = '_▁▂▃▄▅▆▇█'
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.ini")
+
+def load_config(path=CONFIG_PATH):
+    import configparser
+    conf = configparser.ConfigParser()
+    conf.read(path)
+    return conf
 
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument('-i', '--image', help='Image file to print.')
+    p.add_argument('-t', '--transport', help='Printer transport: rfcomm://ADDR[/CH], serial:///dev/rfcomm0, tcp://HOST[:PORT] or emu://. Defaults to the address in config.ini.')
     p.add_argument('-c', '--rfcomm-channel', help='RFCOMM channel. Normally this does not need to be changed.', default=1, type=int)
     p.add_argument('-n', '--no-print', help='Only configure the printer and send the image but do not send print command.', action='store_true')
     p.add_argument('-F', '--no-feed', help='Disable feeding at the end of the print (chaining).')
     p.add_argument('-a', '--auto-cut', help='Enable auto-cutting (or print label boundary on e.g. PT-P300BT).')
     p.add_argument('-m', '--end-margin', help='End margin (in dots).', default=0, type=int)
     p.add_argument('-r', '--raw', help='Send the image to printer as-is without any pre-processing.', action='store_true')
+    p.add_argument('-D', '--dither', help='Preprocess the image with NumPy using this dither instead of the PIL chain. bayer and threshold are much faster for text and codes.', choices=DITHERS)
+    p.add_argument('-S', '--stream', help='Process the image in strips while sending, for very long images (ignored with --raw).', action='store_true')
+    p.add_argument('-T', '--trim', help='Drop blank lines at both ends of the label and feed them as page margin instead.', action='store_true')
     p.add_argument('-C', '--nocomp', help='Disable compression.', action='store_true')
+    p.add_argument('-A', '--adaptive', help='Send each line compressed or raw, whichever is smaller, and reuse frames of repeated lines.', action='store_true')
     p.add_argument('-l', '--label', help="String to print.")
+    p.add_argument('--code128', help='Print this text as a Code 128 barcode.')
+    p.add_argument('--qr', help='Print this text as a QR code.')
+    p.add_argument('--caption', help='Print the barcode or QR code text under it.', action='store_true')
     p.add_argument('-v', '--vertical', help="Print in vertical.", action='store_true')
     p.add_argument('-s', '--size', help="Front size.", type=int, default=0)
+    p.add_argument('--cache-dir', help='Reuse rendered and encoded labels from this directory.')
+    p.add_argument('-b', '--batch', help="Print every label of a CSV or JSON lines file ('-' for stdin) as chained pages in one session.")
+    p.add_argument('--mtu', help='Largest single write to the transport, in bytes.', type=int, default=transport.DEFAULT_MTU)
+    p.add_argument('--flush-bytes', help='Flush the send buffer once this many bytes are queued.', type=int, default=transport.DEFAULT_MTU)
+    p.add_argument('--flush-lines', help='Flush the send buffer after this many raster lines.', type=int)
+    p.add_argument('--flush-at-end', help='Hold all data until the end of the job, then send it in MTU-sized writes.', action='store_true')
+    p.add_argument('--dry-run', help='Render and encode the job without connecting to the printer.', action='store_true')
+    p.add_argument('-o', '--output', help='Write the encoded PTCBP stream to this file instead of printing (implies --dry-run).')
+    p.add_argument('--metrics', help='Write per-job timings and counters to this file, as Prometheus text for *.prom and JSON otherwise.')
     return p, p.parse_args()
 
 def reset_printer(ser):
@@ -41,9 +66,7 @@ def reset_printer(ser):
     # Enter raster graphics (PTCBP) mode
     ser.send(ptcbp.serialize_control('use_command_set', ptcbp.CommandSet.ptcbp))
 
-def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False, auto_cut=False, end_margin=0):
-    reset_printer(ser)
-
+def set_print_parameters(ser, raster_lines, tape_dim, follow_up=False):
     type_, width, length = tape_dim
     # Set media & quality
     ser.send(ptcbp.serialize_control_obj('set_print_parameters', ptcbp.PrintParameters(
@@ -54,10 +77,15 @@ def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False
         width_mm=width, # Tape width in mm
         length_mm=length, # Label height in mm (0 for continuous roll)
         length_px=raster_lines, # Number of raster lines in image data
-        is_follow_up=0, # Unused
+        is_follow_up=1 if follow_up else 0, # Second and later pages of a chained job
         sbz=0, # Unused
     )))
 
+def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False, auto_cut=False, end_margin=0):
+    reset_printer(ser)
+
+    set_print_parameters(ser, raster_lines, tape_dim)
+
     pm, pm2 = 0, 0
     if not chaining:
         pm2 |= ptcbp.PageModeAdvanced.no_page_chaining
@@ -76,7 +104,12 @@ def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False
     # Set compression mode: TIFF
     ser.send(ptcbp.serialize_control('compression', ptcbp.CompressionType.rle if compress else ptcbp.CompressionType.none))
 
-def do_print_job(ser, args, data):
+def open_sender(ser, args):
+    return transport.BufferedSender(ser, mtu=args.mtu,
+                                    flush_bytes=None if args.flush_at_end else args.flush_bytes,
+                                    flush_lines=None if args.flush_at_end else args.flush_lines)
+
+def query_ready_status(ser):
     print('=> Querying printer status...')
 
     reset_printer(ser)
@@ -90,9 +123,48 @@ def do_print_job(ser, args, data):
         print('** Printer indicates that it is not ready. Refusing to continue.')
         sys.exit(1)
 
+    return status
+
+def send_raster(ser, data, nocomp, stream=None, raster_lines=None, job_metrics=None, adaptive=False):
+    if job_metrics is None:
+        job_metrics = metrics.JobMetrics(enabled=False)
+    if raster_lines is None:
+        raster_lines = len(data) // 16
+    if stream is not None:
+        # Pre-encoded frames (e.g. from the render cache) go out as they are
+        job_metrics.count_stream(stream, raster_lines)
+        ser.send(stream, lines=raster_lines)
+        print('[pre-encoded]')
+        return
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        if adaptive and not nocomp:
+            frames = encode_raster_adaptive(data)
+        else:
+            frames = encode_raster_transfer(data, nocomp)
+    else:
+        # Iterator of raster lines, e.g. from read_png_lines()
+        frames = encode_raster_lines(data, nocomp)
+    progress = metrics.Progress(job_metrics, raster_lines)
+    for line in job_metrics.timed('encode', frames):
+        job_metrics.count_frame(line)
+        ser.send(line, lines=1)
+        progress.update()
+    progress.done()
+
+def do_print_job(ser, args, data, stream=None, raster_lines=None, job_metrics=None):
+    """ Print one image. data is the 1bpp raster, or an iterator of raster lines
+    (see read_png_lines), in which case raster_lines must be given. """
+    if job_metrics is None:
+        job_metrics = metrics.JobMetrics(enabled=False)
+    ser = open_sender(ser, args)
+
+    with job_metrics.stage('handshake'):
+        status = query_ready_status(ser)
+
     print('=> Configuring printer...')
 
-    raster_lines = len(data) // 16
+    if raster_lines is None:
+        raster_lines = len(data) // 16
     configure_printer(ser, raster_lines, (status.tape_type,
                                           status.tape_width,
                                           status.tape_length),
@@ -103,76 +175,344 @@ def do_print_job(ser, args, data):
 
     # Send image data
     print(f"=> Sending image data ({raster_lines} lines)...")
-    sys.stdout.write('[')
-    for line in encode_raster_transfer(data, args.nocomp):
-        if line[0:1] == b'G':
-            sys.stdout.write(BARS[min((len(line) - 3) // 2, 7) + 1])
-        elif line[0:1] == b'Z':
-            sys.stdout.write(BARS[0])
-        sys.stdout.flush()
-        ser.send(line)
-    sys.stdout.write(']')
-
-    print()
+    send_raster(ser, data, args.nocomp, stream, raster_lines, job_metrics, args.adaptive)
     print("=> Image data was sent successfully. Printing will begin soon.")
 
     if not args.no_print:
-        # Print and feed
-        ser.send(ptcbp.serialize_control('print'))
+        with job_metrics.stage('completion'):
+            # Print and feed
+            ser.send(ptcbp.serialize_control('print'))
 
-        # Dump status that the printer returns
-        status = ptstatus.unpack_status(ser.recv(32))
+            # Dump status that the printer returns
+            status = ptstatus.unpack_status(ser.recv(32))
         ptstatus.print_status(status)
 
+    ser.flush()
+    job_metrics.collect_sender(ser)
+    print(f"=> Sent {ser.bytes_sent} bytes in {ser.writes} writes ({ser.flushes} flushes).")
     print("=> All done.")
 
+def send_pages(ser, pages, tape_dim, compress=True, auto_cut=False, end_margin=0, verbose=True, job_metrics=None, chaining=False):
+    """ Send pages (render_cache.CacheEntry list) as one job, print_page between pages and print after the last
+
+    chaining leaves the tape unfed after the last page, like -F for a single label.
+    """
+    for i, (data, stream) in enumerate(pages):
+        raster_lines = len(data) // 16
+        if i == 0:
+            configure_printer(ser, raster_lines, tape_dim,
+                              chaining=chaining,
+                              auto_cut=auto_cut,
+                              end_margin=end_margin,
+                              compress=compress)
+        else:
+            set_print_parameters(ser, raster_lines, tape_dim, follow_up=True)
+
+        if verbose:
+            print(f"=> Sending page {i + 1}/{len(pages)} ({raster_lines} lines)...")
+            send_raster(ser, data, not compress, stream, raster_lines, job_metrics)
+        else:
+            ser.send(stream if stream is not None else encode_raster_bulk(data, not compress), lines=raster_lines)
+
+        # Feed between pages, print and feed after the last one
+        ser.send(ptcbp.serialize_control('print' if i == len(pages) - 1 else 'print_page'))
+
+def encode_job(pages, tape_dim, compress=True, auto_cut=False, end_margin=0, chaining=False):
+    """ The PTCBP stream send_pages() produces, minus the status handshake before it """
+    out = transport.FrameBuffer()
+    send_pages(out, pages, tape_dim, compress, auto_cut, end_margin, verbose=False, chaining=chaining)
+    return bytes(out)
+
+def trim_pages(pages, end_margin=0):
+    """ Drop the blank raster lines pages start and end with, and feed them as page margin instead
+
+    set_page_margin feeds the same amount before and after every page of a job, so
+    the same number of lines is cut from both ends of every page: the shortest
+    blank run at either end of any of them. Blank lines are single Z frames in
+    every encoding, so pre-encoded streams are trimmed by slicing. Returns the
+    trimmed pages (render_cache.CacheEntry list), the new end margin and the
+    raster lines and bytes saved (not counted for streams that had to be encoded again).
+    """
+    trim = min(min(blank_runs(data)) for data, _ in pages) if pages else 0
+    # An all-blank page still needs a line to print
+    trim = min([trim] + [max(len(data) // 16 - 1, 0) // 2 for data, _ in pages])
+    if trim == 0:
+        return pages, end_margin, 0, 0
+    zerofill = ptcbp.serialize_control('zerofill')
+    blank = zerofill * trim
+    trimmed = []
+    saved_bytes = 0
+    for data, stream in pages:
+        data = data[trim * 16:len(data) - trim * 16]
+        if stream is None:
+            # Encoded while sending, minus the Z frames of the trimmed lines
+            saved_bytes += 2 * len(blank)
+        elif stream[:len(blank)] == blank and stream[len(stream) - len(blank):] == blank:
+            stream = stream[len(blank):len(stream) - len(blank)]
+            saved_bytes += 2 * len(blank)
+        else:
+            # Not a plain frame per line, encode again
+            stream = None
+        trimmed.append(render_cache.CacheEntry(data, stream))
+    return trimmed, end_margin + trim, 2 * trim * len(pages), saved_bytes
+
+def encode_print_job(args, data, stream, raster_lines, tape_dim):
+    """ The PTCBP stream do_print_job() sends, minus the status handshake before it """
+    out = transport.FrameBuffer()
+    if raster_lines is None:
+        raster_lines = len(data) // 16
+    configure_printer(out, raster_lines, tape_dim,
+                      chaining=args.no_feed,
+                      auto_cut=args.auto_cut,
+                      end_margin=args.end_margin,
+                      compress=not args.nocomp)
+    if stream is None:
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = b''.join(data)
+        if args.adaptive and not args.nocomp:
+            stream = b''.join(encode_raster_adaptive(data))
+        else:
+            stream = encode_raster_bulk(data, args.nocomp)
+    out.send(stream)
+    if not args.no_print:
+        out.send(ptcbp.serialize_control('print'))
+    return bytes(out)
+
+def wait_pages_completed(ser, pages):
+    # The printer reports completion of every page, stop at the last one or an error
+    completed = 0
+    while completed < pages:
+        status = ptstatus.unpack_status(ser.recv(32))
+        if status.status_type == 0x01:
+            completed += 1
+        elif status.status_type == 0x02:
+            ptstatus.print_status(status)
+            print(f'** Printer reported an error after {completed} of {pages} pages.')
+            sys.exit(1)
+    ptstatus.print_status(status)
+
+def do_batch_job(ser, args, pages, job_metrics=None):
+    """ Print several images in one session as chained pages
+
+    pages is a list of render_cache.CacheEntry, stream may be None if not pre-encoded.
+    """
+    if job_metrics is None:
+        job_metrics = metrics.JobMetrics(enabled=False)
+    ser = open_sender(ser, args)
+
+    with job_metrics.stage('handshake'):
+        status = query_ready_status(ser)
+    tape_dim = (status.tape_type, status.tape_width, status.tape_length)
+
+    print(f'=> Configuring printer for {len(pages)} pages...')
+    send_pages(ser, pages, tape_dim, compress=not args.nocomp, auto_cut=args.auto_cut, end_margin=args.end_margin,
+               job_metrics=job_metrics, chaining=args.no_feed)
+
+    with job_metrics.stage('completion'):
+        wait_pages_completed(ser, len(pages))
+
+    ser.flush()
+    job_metrics.collect_sender(ser)
+    print(f"=> Sent {ser.bytes_sent} bytes in {ser.writes} writes ({ser.flushes} flushes).")
+    print(f"=> All done, {len(pages)} pages printed.")
+
+def read_batch(path):
+    """ Read batch jobs from a CSV file, a JSON lines file or stdin ('-')
+
+    Every job is a dict with either a 'label' (text to render, with optional
+    'vertical', 'size' and 'font'), an 'image' path (with optional 'raw' or 'dither') or
+    a 'code128' or 'qr' value (with optional 'caption' and 'module'). CSV files
+    need a header row; stdin takes JSON lines or one plain text label per line.
+    """
+    if path == '-':
+        lines = [l.rstrip('\n') for l in sys.stdin if l.strip()]
+        if lines and lines[0].lstrip().startswith('{'):
+            return [json.loads(l) for l in lines]
+        return [{'label': l} for l in lines]
+    with open(path, newline='') as f:
+        if path.lower().endswith('.csv'):
+            return list(csv.DictReader(f))
+        return [json.loads(l) for l in f if l.strip()]
+
+def _flag(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y')
+    return bool(value)
+
+def render_job(job, tape_width, cache=None, nocomp=False):
+    """ Render a batch job to a render_cache.CacheEntry
+
+    Without a cache the stream is None and the raster gets encoded while sending.
+    """
+    if job.get('label'):
+        vertical, size, font = _flag(job.get('vertical')), int(job.get('size') or 0), job.get('font') or None
+        from characters import draw_text, draw_text_raster
+        if vertical:
+            render = lambda: read_png(None, False, False, False, draw_text(job['label'], font, vertical=True, fontsize=size, tape_width=tape_width))
+        else:
+            render = lambda: draw_text_raster(job['label'], font, fontsize=size, tape_width=tape_width)
+        key = lambda: render_cache.text_key(job['label'], font, size, vertical, tape_width, nocomp)
+    elif job.get('image'):
+        image, raw, dither = job['image'], _flag(job.get('raw')), job.get('dither')
+        if raw:
+            render = lambda: read_png(image, False, False, False)
+        elif dither:
+            import raster
+            render = lambda: raster.read_png_fast(image, dither)
+        else:
+            render = lambda: read_png(image)
+        def key():
+            if hasattr(image, 'getvalue'):
+                blob = image.getvalue()
+            else:
+                with open(image, 'rb') as f:
+                    blob = f.read()
+            return render_cache.image_key(blob, not raw, not raw, False if raw else dither or True, nocomp)
+    elif job.get('code128') or job.get('qr'):
+        import barcode
+        kind = 'code128' if job.get('code128') else 'qr'
+        value, caption = job[kind], _flag(job.get('caption'))
+        module = int(job['module']) if job.get('module') else None
+        if kind == 'code128':
+            render = lambda: barcode.code128(value, module or 2, caption=caption)
+        else:
+            render = lambda: barcode.qr(value, module, caption=caption)
+        key = lambda: render_cache.barcode_key(kind, value, module, caption, nocomp)
+    else:
+        raise ValueError(f'Batch job has neither a label, an image nor a code: {job}')
+    if cache is None:
+        return render_cache.CacheEntry(render(), None)
+    return cache.get_or_render(key(), render, nocomp)
+
+def confirm_print():
+    """ Ask on the terminal, True unless ESC is pressed """
+    import curses
+    stdscr = curses.initscr()
+    stdscr.addstr(10, 10, "Press ESC to cancel, or any other key to print the label...")
+    stdscr.refresh()
+    c = stdscr.getch()
+    curses.endwin()
+    return c != 27
+
 def main():
     p, args = parse_args()
 
+    conf = load_config()
+    printer_address = conf.get("printer", 'address', fallback=None)
+    tape_width = conf.getint("printer", "tape_width", fallback=12)
+    offline = args.dry_run or args.output is not None
+
+    cache = render_cache.RenderCache(args.cache_dir) if args.cache_dir else None
+    job_metrics = metrics.JobMetrics(enabled=args.metrics is not None)
     data = None
-    if args.label:
+    stream = None
+    raster_lines = None
+    if args.batch:
+        jobs = read_batch(args.batch)
+        print(f"Rendering {len(jobs)} labels")
+        with job_metrics.stage('render'):
+            data = [render_job(job, tape_width, cache, args.nocomp) for job in jobs]
+        if not data:
+            print('** Batch is empty.')
+            sys.exit(1)
+
+    elif args.label:
         print("Processing %s" %(args.label))
-        img = draw_text(args.label, vertical = args.vertical, fontsize = args.size, tape_width = tape_width)
-        ImageOps.mirror(img).show()
+        key = render_cache.text_key(args.label, None, args.size, args.vertical, tape_width, args.nocomp)
+        entry = cache.get(key) if cache is not None else None
+        img = None
+        if entry is None and not args.vertical:
+            # Horizontal labels render straight to the raster
+            from characters import draw_text_raster
+            with job_metrics.stage('render'):
+                data = draw_text_raster(args.label, fontsize = args.size, tape_width = tape_width)
+        elif entry is None:
+            from characters import draw_text
+            with job_metrics.stage('render'):
+                img = draw_text(args.label, vertical = args.vertical, fontsize = args.size, tape_width = tape_width)
+
+        if not offline:
+            from PIL import Image, ImageOps
+            if img is None:
+                # Preview straight from the cached or rendered raster
+                preview = entry.raster if entry is not None else data
+                img = Image.frombytes('1', (128, len(preview) // 16), preview)
+            ImageOps.mirror(img).show()
+
+            # if Not ESC , go print
+            if not confirm_print():
+                sys.exit(0)
+            print("Printing")
 
+        if entry is not None:
+            data, stream = entry
+        else:
+            if data is None:
+                with job_metrics.stage('read_png'):
+                    data = read_png(None, False, False, False, img)
+            if cache is not None:
+                stream = cache.put(key, data, encode_raster_bulk(data, args.nocomp)).stream
 
-        stdscr = curses.initscr()
-        stdscr.addstr(10, 10, "Press ESC to cancel, or any other key to print the label...")
-        stdscr.refresh()
-        c = stdscr.getch()
-        curses.endwin()
+    elif args.code128 or args.qr:
+        with job_metrics.stage('render'):
+            data, stream = render_job({'code128': args.code128, 'qr': args.qr, 'caption': args.caption}, tape_width, cache, args.nocomp)
 
-        # if Not ESC , go print
-        if c != 27 :
-            print("Printing")
-            data = read_png(None, False, False, False, img)
-        else:
-            sys.exit(0)
+    elif args.image and args.stream and not args.raw:
+        # Decode once, then rotate/pad/encode strip by strip while sending
+        raster_lines = raster_line_count(args.image)
+        data = read_png_lines(args.image)
 
     elif args.image:
         # Read input image into memory
-        if args.raw:
-            data = read_png(args.image, False, False, False)
+        with job_metrics.stage('read_png'):
+            data, stream = render_job({'image': args.image, 'raw': args.raw, 'dither': args.dither}, tape_width, cache, args.nocomp)
+
+    if args.trim and data is not None and (args.batch or isinstance(data, (bytes, bytearray))):
+        pages = data if args.batch else [render_cache.CacheEntry(data, stream)]
+        pages, args.end_margin, lines, saved = trim_pages(pages, args.end_margin)
+        if args.batch:
+            data = pages
         else:
-            data = read_png(args.image)
-
-    # Get bluetooth socket
-    with contextlib.closing(bluetooth.BluetoothSocket(bluetooth.RFCOMM)) as ser:
-        print('=> Connecting to printer...')
-        ser.connect((printer_address, args.rfcomm_channel))
-
-        try:
-            assert data is not None
-            do_print_job(ser, args, data)
-        finally:
-            # Initialize
-            reset_printer(ser)
+            (data, stream), = pages
+        print(f"=> Trimmed {lines} blank lines ({saved} bytes), end margin is now {args.end_margin} dots")
+
+    if offline:
+        # No printer to ask, encode for the configured tape
+        assert data is not None
+        tape_dim = (ptcbp.MediaType.laminated, tape_width, 0)
+        with job_metrics.stage('encode'):
+            if args.batch:
+                job = encode_job(data, tape_dim, not args.nocomp, args.auto_cut, args.end_margin, args.no_feed)
+            else:
+                job = encode_print_job(args, data, stream, raster_lines, tape_dim)
+        if args.output:
+            with open(args.output, 'wb') as f:
+                f.write(job)
+            print(f"=> Wrote {len(job)} bytes to {args.output}")
+        else:
+            print(f"=> Dry run, job is {len(job)} bytes")
+    else:
+        # Get printer connection
+        with contextlib.closing(transport.open_transport(args.transport or printer_address, args.rfcomm_channel)) as ser:
+            print('=> Connecting to printer...')
+            with job_metrics.stage('connect'):
+                ser.connect()
+
+            try:
+                assert data is not None
+                if args.batch:
+                    do_batch_job(ser, args, data, job_metrics)
+                else:
+                    do_print_job(ser, args, data, stream, raster_lines, job_metrics)
+            finally:
+                # Initialize
+                reset_printer(ser)
+
+    if cache is not None:
+        print(f"=> Render cache: {cache.stats()}")
+    if args.metrics:
+        job_metrics.write(args.metrics)
+        print(f"=> Metrics written to {args.metrics}")
 
 if __name__ == '__main__':
-
-
-    conf = configparser.ConfigParser()
-    conf.read(os.path.join(os.path.dirname(__file__), "config.ini"))
-    printer_address = conf.get("printer", 'address')
-    tape_width = conf.get("printer", "tape_width")
     main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# asyncio print engine
+#
+# A background reader decodes every 32-byte status frame the printer sends while
+# raster data is streamed, so buffer-full and error states are seen mid-job and a
+# job only finishes once the printer reports "Printing completed".
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+
+import ptcbp
+import ptstatus
+import transport
+from labelmaker import configure_printer
+from labelmaker_encode import encode_raster_bulk, read_png
+
+STATUS_SIZE = 32
+BUFFER_FULL = 1 << 3 # ERR_FLAGS: Communication buffer full
+
+class PrinterError(RuntimeError):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+def describe_status(status):
+    return (f'{ptstatus.describe_code(status.status_type, ptstatus.STATUS_TYPE)}, '
+            f'errors: {ptstatus.describe_flag(status.err, ptstatus.ERR_FLAGS)}')
+
+class AsyncPrinter(object):
+    """ One printer connection driven from asyncio
+
+    Blocking transport calls run on a private two-thread executor, one for the
+    status reader and one for sends, so any number of printers can be driven from
+    a single event loop.
+    """
+    def __init__(self, conn, mtu=transport.DEFAULT_MTU, poll_interval=0.5, on_status=None, name=None):
+        self.conn = conn
+        self.name = name
+        self.mtu = mtu
+        self.poll_interval = poll_interval
+        self.on_status = on_status
+        self.status = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self._statuses = asyncio.Queue()
+        self._can_send = asyncio.Event()
+        self._can_send.set()
+        self._fault = None
+        self._reader = None
+        self._lock = asyncio.Lock()
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _send(self, data):
+        view = memoryview(data)
+        while view:
+            sent = await self._call(self.conn.send, view)
+            view = view[sent:]
+
+    @property
+    def closed(self):
+        """ True until open() and again once the status reader saw the connection end """
+        return self._reader is None or self._reader.done()
+
+    async def open(self):
+        await self._call(self.conn.connect)
+        self._reader = asyncio.get_running_loop().create_task(self._read_statuses())
+        return self
+
+    async def close(self):
+        # Closing the transport makes the pending recv() return, which ends the reader
+        await self._call(self.conn.close)
+        if self._reader is not None:
+            with contextlib.suppress(asyncio.CancelledError, OSError):
+                await self._reader
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _read_statuses(self):
+        buf = bytearray()
+        while True:
+            chunk = await self._call(self.conn.recv, STATUS_SIZE - len(buf))
+            if not chunk:
+                self._dispatch(None)
+                return
+            buf += chunk
+            if len(buf) == STATUS_SIZE:
+                self._dispatch(ptstatus.unpack_status(bytes(buf)))
+                buf.clear()
+
+    def _dispatch(self, status):
+        if status is None:
+            self._fault = PrinterError('Connection closed by printer')
+            self._can_send.set()
+            self._statuses.put_nowait(None)
+            return
+        self.status = status
+        if self.on_status is not None:
+            self.on_status(self, status)
+        if status.err & BUFFER_FULL:
+            self._can_send.clear()
+        else:
+            self._can_send.set()
+        if status.err & ~BUFFER_FULL or status.phase_type << 16 | status.phase == 0x010014:
+            self._fault = PrinterError(f'Printer reported an error: {describe_status(status)}', status)
+            self._can_send.set()
+        self._statuses.put_nowait(status)
+
+    def _check_fault(self):
+        if self._fault is not None:
+            raise self._fault
+
+    async def _next_status(self, predicate, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            status = await asyncio.wait_for(self._statuses.get(), remaining)
+            self._check_fault()
+            if predicate(status):
+                return status
+
+    async def query_status(self, timeout=5.0):
+        await self._send(ptcbp.serialize_control('get_status'))
+        return await self._next_status(lambda s: s.status_type == 0x00, timeout)
+
+    async def recover(self, timeout=5.0):
+        """ Forget the fault of the last job and query the status afresh """
+        async with self._lock:
+            while not self._statuses.empty():
+                self._statuses.get_nowait()
+            self._fault = None
+            self._can_send.set()
+            return await self.query_status(timeout)
+
+    async def _wait_can_send(self):
+        # While the buffer is full, keep asking so the printer tells us when it drained
+        while not self._can_send.is_set():
+            try:
+                await asyncio.wait_for(self._can_send.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                await self._send(ptcbp.serialize_control('get_status'))
+        self._check_fault()
+
+    async def print(self, data, compress=True, chaining=False, auto_cut=False, end_margin=0, timeout=60.0):
+        """ Print one 1bpp image and return the "Printing completed" status """
+        async with self._lock:
+            while not self._statuses.empty():
+                self._statuses.get_nowait()
+            self._fault = None
+            try:
+                return await self._print(data, compress, chaining, auto_cut, end_margin, timeout)
+            except BaseException:
+                # Abort: drop whatever the printer buffered for this job
+                with contextlib.suppress(OSError):
+                    await self._send(ptcbp.serialize_control('reset'))
+                raise
+
+    async def _print(self, data, compress, chaining, auto_cut, end_margin, timeout):
+        frames = transport.FrameBuffer(b'\x00' * 64 + ptcbp.serialize_control('reset'))
+        await self._send(frames)
+        status = await self.query_status()
+        if status.err != 0x0000 or status.phase_type != 0x00 or status.phase != 0x0000:
+            raise PrinterError('Printer indicates that it is not ready', status)
+
+        frames = transport.FrameBuffer()
+        configure_printer(frames, len(data) // 16, (status.tape_type, status.tape_width, status.tape_length),
+                          compress=compress, chaining=chaining, auto_cut=auto_cut, end_margin=end_margin)
+        await self._send(frames)
+
+        # Chunks end on frame boundaries so status polls never land inside a frame
+        for chunk in ptcbp.split_frames(encode_raster_bulk(data, not compress), self.mtu):
+            await self._wait_can_send()
+            await self._send(chunk)
+
+        await self._wait_can_send()
+        await self._send(ptcbp.serialize_control('print'))
+        return await self._next_status(lambda s: s.status_type == 0x01, timeout)
+
+async def print_many(specs, images, compress=True):
+    """ Spread images round-robin over several printers and print concurrently """
+    def show(printer, status):
+        print(f'[{printer.name}] {describe_status(status)}')
+
+    async def run(spec, queue):
+        async with AsyncPrinter(transport.open_transport(spec), on_status=show, name=spec) as printer:
+            for path in queue:
+                await printer.print(read_png(path), compress=compress)
+                print(f'[{spec}] {path} done')
+
+    await asyncio.gather(*(run(spec, images[i::len(specs)]) for i, spec in enumerate(specs)))
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Print images on one or more printers concurrently.')
+    p.add_argument('-t', '--transport', help='Printer transport spec, can be repeated.', action='append', required=True)
+    p.add_argument('-i', '--image', help='Image file to print, can be repeated.', action='append', required=True)
+    p.add_argument('-C', '--nocomp', help='Disable compression.', action='store_true')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    asyncio.run(print_many(args.transport, args.image, not args.nocomp))
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# Persistent print daemon
+#
+# Keeps the printer connection open between labels (polling get_status as a
+# keep-alive and reconnecting when it drops) and takes jobs over a Unix socket.
+# The protocol is one JSON object per line in each direction:
+#
+#   {"op": "print", "label": "A-0001", "vertical": false, "size": 0, "priority": 0, "wait": true}
+#   {"op": "print", "png": "<base64>", "raw": false}
+#   {"op": "status", "id": 3}
+#
+# Jobs are rendered by a separate thread, so the next label is ready by the time
+# the current one has finished printing.
+
+import argparse
+import base64
+import configparser
+import contextlib
+import io
+import itertools
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import ptcbp
+import ptstatus
+import render_cache
+import transport
+from labelmaker import configure_printer, reset_printer, render_job
+from labelmaker_encode import encode_raster_bulk
+
+DEFAULT_SOCKET = '/tmp/labelmaker.sock'
+KEEPALIVE_INTERVAL = 10.0
+RECONNECT_DELAY = 2.0
+# Finished jobs kept around for status requests
+JOB_HISTORY = 1000
+
+class Job(object):
+    def __init__(self, job_id, spec, priority=0):
+        self.id = job_id
+        self.spec = spec
+        self.priority = priority
+        self.state = 'queued'
+        self.error = None
+        self.data = None
+        self.times = {'queued': time.monotonic()}
+        self.done = threading.Event()
+
+    def mark(self, state):
+        self.state = state
+        self.times[state] = time.monotonic()
+
+    def finish(self):
+        # Only the report is needed from here on, let go of the image and raster
+        self.spec = self.data = None
+        self.done.set()
+
+    def report(self):
+        t = self.times
+        timing = {}
+        for name, start, end in (('wait', 'queued', 'rendering'), ('render', 'rendering', 'rendered'),
+                                 ('print', 'printing', self.state), ('total', 'queued', self.state)):
+            if start in t and end in t and self.done.is_set():
+                timing[name] = round(t[end] - t[start], 4)
+        return {'id': self.id, 'state': self.state, 'error': self.error, 'timing': timing}
+
+class PrintDaemon(object):
+    def __init__(self, spec, tape_width=12, keepalive=KEEPALIVE_INTERVAL, args=None, cache=None, history=JOB_HISTORY):
+        self.spec = spec
+        self.history = history
+        self.cache = cache
+        self.tape_width = tape_width
+        self.keepalive = keepalive
+        self.args = args or argparse.Namespace(nocomp=False, auto_cut=False, end_margin=0)
+        self.conn = None
+        self.jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending = queue.PriorityQueue()
+        # Holds the one job rendered ahead of the one currently printing
+        self._rendered = queue.Queue(maxsize=1)
+        self._stop = threading.Event()
+        self._threads = []
+
+    def submit(self, spec):
+        job = Job(next(self._ids), spec, int(spec.get('priority', 0)))
+        with self._jobs_lock:
+            self.jobs[job.id] = job
+            excess = len(self.jobs) - self.history
+            if excess > 0:
+                for old in [j for j in self.jobs.values() if j.done.is_set()][:excess]:
+                    del self.jobs[old.id]
+        self._pending.put((-job.priority, job.id, job))
+        return job
+
+    def start(self):
+        for target in (self._render_loop, self._print_loop):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        self._stop.set()
+        self._pending.put((float('inf'), 0, None))
+        for t in self._threads:
+            t.join()
+        self._disconnect()
+
+    def _render_loop(self):
+        while not self._stop.is_set():
+            _, _, job = self._pending.get()
+            if job is None:
+                break
+            job.mark('rendering')
+            try:
+                job.data = render_job(job.spec, self.tape_width, self.cache, self.args.nocomp)
+                job.mark('rendered')
+            except Exception as e:
+                job.error = f'{type(e).__name__}: {e}'
+                job.mark('failed')
+                job.finish()
+                continue
+            self._rendered.put(job)
+        self._rendered.put(None)
+
+    def _connect(self):
+        while not self._stop.is_set():
+            try:
+                conn = transport.open_transport(self.spec)
+                conn.connect()
+                self.conn = conn
+                print(f'=> Connected to {self.spec}')
+                return
+            except Exception as e:
+                print(f'** Connecting to {self.spec} failed ({type(e).__name__}: {e}), retrying in {RECONNECT_DELAY}s')
+                self._stop.wait(RECONNECT_DELAY)
+
+    def _disconnect(self):
+        if self.conn is not None:
+            with contextlib.suppress(OSError):
+                self.conn.close()
+            self.conn = None
+
+    def _query_status(self, conn):
+        conn.send(ptcbp.serialize_control('get_status'))
+        # Skip phase change frames left over from the previous job
+        status = ptstatus.unpack_status(conn.recv(32))
+        while status.status_type != 0x00:
+            status = ptstatus.unpack_status(conn.recv(32))
+        if status.err != 0x0000 or status.phase_type != 0x00 or status.phase != 0x0000:
+            raise RuntimeError(f'Printer is not ready (errors: {ptstatus.describe_flag(status.err, ptstatus.ERR_FLAGS)})')
+        return status
+
+    def _print(self, entry):
+        data, stream = entry
+        conn = transport.BufferedSender(self.conn)
+        reset_printer(conn)
+        status = self._query_status(conn)
+        configure_printer(conn, len(data) // 16, (status.tape_type, status.tape_width, status.tape_length),
+                          compress=not self.args.nocomp, auto_cut=self.args.auto_cut, end_margin=self.args.end_margin)
+        conn.send(stream if stream is not None else encode_raster_bulk(data, self.args.nocomp))
+        conn.send(ptcbp.serialize_control('print'))
+        while True:
+            status = ptstatus.unpack_status(conn.recv(32))
+            if status.status_type == 0x01:
+                return
+            if status.status_type == 0x02:
+                raise RuntimeError(f'Printer reported an error: {ptstatus.describe_flag(status.err, ptstatus.ERR_FLAGS)}')
+
+    def _print_loop(self):
+        self._connect()
+        while not self._stop.is_set():
+            try:
+                job = self._rendered.get(timeout=self.keepalive)
+            except queue.Empty:
+                # Idle: keep the link warm and notice when it went away
+                try:
+                    self._query_status(self.conn)
+                except RuntimeError:
+                    pass
+                except Exception:
+                    self._disconnect()
+                    self._connect()
+                continue
+            if job is None:
+                break
+            job.mark('printing')
+            try:
+                self._print(job.data)
+                job.mark('done')
+            except RuntimeError as e:
+                job.error = str(e)
+                job.mark('failed')
+                with contextlib.suppress(OSError):
+                    reset_printer(self.conn)
+            except Exception as e:
+                # OSError or ValueError (short status read): the link most likely dropped mid-job.
+                # Anything else leaves the link in an unknown state, so start over as well.
+                job.error = f'{type(e).__name__}: {e}'
+                job.mark('failed')
+                self._disconnect()
+                self._connect()
+            finally:
+                job.finish()
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.print_daemon
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'print':
+                    spec = dict(request)
+                    if 'png' in spec:
+                        spec['image'] = io.BytesIO(base64.b64decode(spec.pop('png')))
+                    job = daemon.submit(spec)
+                    if request.get('wait', True):
+                        job.done.wait()
+                    reply = job.report()
+                elif op == 'status':
+                    job = daemon.jobs.get(request.get('id'))
+                    reply = job.report() if job is not None else {'error': 'Unknown job'}
+                elif op == 'cache':
+                    reply = daemon.cache.stats() if daemon.cache is not None else {'error': 'Cache disabled'}
+                else:
+                    reply = {'error': f'Unknown op {op}'}
+            except (ValueError, TypeError) as e:
+                reply = {'error': str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        super().__init__(path, _RequestHandler)
+        self.print_daemon = daemon
+
+def request(path, message):
+    """ Send one request to a running daemon and return its reply """
+    with contextlib.closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
+        sock.connect(path)
+        f = sock.makefile('rwb')
+        f.write(json.dumps(message).encode() + b'\n')
+        f.flush()
+        return json.loads(f.readline())
+
+def parse_args():
+    conf = configparser.ConfigParser()
+    conf.read(os.path.join(os.path.dirname(__file__), "config.ini"))
+
+    p = argparse.ArgumentParser(description='Persistent label printing daemon.')
+    p.add_argument('-S', '--socket', help='Unix socket path.', default=DEFAULT_SOCKET)
+    sub = p.add_subparsers(dest='command', required=True)
+    serve = sub.add_parser('serve', help='Run the daemon.')
+    serve.add_argument('-t', '--transport', help='Printer transport spec.', default=conf.get('printer', 'address', fallback=None))
+    serve.add_argument('-k', '--keepalive', help='Seconds between keep-alive status polls.', type=float, default=KEEPALIVE_INTERVAL)
+    serve.add_argument('-C', '--nocomp', help='Disable compression.', action='store_true')
+    serve.add_argument('-a', '--auto-cut', help='Enable auto-cutting.', action='store_true')
+    serve.add_argument('-m', '--end-margin', help='End margin (in dots).', default=0, type=int)
+    serve.add_argument('--cache-dir', help='Reuse rendered and encoded labels from this directory.')
+    serve.add_argument('--tape-width', help='Tape width in mm.', type=int, default=conf.getint('printer', 'tape_width', fallback=12))
+    submit = sub.add_parser('submit', help='Queue a label on a running daemon.')
+    submit.add_argument('-l', '--label', help='String to print.')
+    submit.add_argument('-i', '--image', help='PNG file to print.')
+    submit.add_argument('-v', '--vertical', help='Print in vertical.', action='store_true')
+    submit.add_argument('-s', '--size', help='Font size.', type=int, default=0)
+    submit.add_argument('-p', '--priority', help='Higher prints first.', type=int, default=0)
+    submit.add_argument('-q', '--no-wait', help='Return as soon as the job is queued.', action='store_true')
+    args = p.parse_args()
+    if args.command == 'serve':
+        # The print thread retries connecting forever, a spec that can never work has to fail here
+        if not args.transport:
+            p.error('no printer given, pass -t or set [printer] address in config.ini')
+        try:
+            transport.open_transport(args.transport)
+        except ValueError as e:
+            p.error(str(e))
+    return args
+
+def main():
+    args = parse_args()
+    if args.command == 'submit':
+        message = {'op': 'print', 'priority': args.priority, 'wait': not args.no_wait}
+        if args.image:
+            with open(args.image, 'rb') as f:
+                message['png'] = base64.b64encode(f.read()).decode()
+        else:
+            message.update(label=args.label, vertical=args.vertical, size=args.size)
+        print(json.dumps(request(args.socket, message)))
+        return
+
+    cache = render_cache.RenderCache(args.cache_dir) if args.cache_dir else None
+    daemon = PrintDaemon(args.transport, args.tape_width, args.keepalive, args, cache)
+    daemon.start()
+    server = DaemonServer(args.socket, daemon)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f'=> Listening on {args.socket}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(args.socket)
+        daemon.stop()
+
+if __name__ == '__main__':
+    main()
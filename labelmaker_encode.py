@@ -1,6 +1,10 @@
 import ptcbp
-from PIL import Image, ImageOps
-from io import BytesIO
+
+# numpy and PIL are imported by the functions that use them, so sending frames
+# that are already encoded (render cache hits, spools) never loads either
+
+# raster.ink_mask modes, kept here so the CLI can offer them without importing raster
+DITHERS = ('threshold', 'bayer', 'floyd-steinberg')
 
 def encode_raster_transfer(data, nocomp=False):
     """ Encode 1 bit per pixel image data for transfer over serial to the printer """
@@ -16,12 +20,141 @@ def encode_raster_transfer(data, nocomp=False):
         else:
             yield ptcbp.serialize_data(chunk, 'none' if nocomp else 'rle')
 
+def encode_raster_bulk(data, nocomp=False):
+    """ Encode a whole 1bpp image into one contiguous PTCBP byte string
+
+    The output is byte-for-byte identical to b''.join(encode_raster_transfer(data, nocomp)),
+    but blank lines are classified for the whole image in one NumPy pass and the
+    G/Z frames are appended straight into a single buffer instead of going through
+    an Opcode/Data/BytesIO round-trip per line.
+    """
+    import numpy as np
+    chunk_size = 16
+    view = memoryview(data).cast('B')
+    full = len(view) - len(view) % chunk_size
+    rows = np.frombuffer(view[:full], dtype=np.uint8).reshape(-1, chunk_size)
+    compress = ptcbp.COMPRESSIONS_TABLE['none' if nocomp else 'rle'][0]
+    zerofill = ptcbp.FRAMES['zerofill']
+
+    out = bytearray()
+    for i, nonzero in enumerate(rows.any(axis=1).tolist()):
+        if nonzero:
+            payload = compress(bytes(view[i * chunk_size : (i + 1) * chunk_size]))
+            out += b'G'
+            out += len(payload).to_bytes(2, 'little')
+            out += payload
+        else:
+            out += zerofill
+    if full != len(view):
+        # A trailing partial line is never treated as blank, same as the generator
+        out += ptcbp.serialize_data(bytes(view[full:]), 'none' if nocomp else 'rle')
+    return bytes(out)
+
+# A PackBits literal packet of a whole line: header 0x0f (16 bytes follow) plus the line
+LITERAL_LINE_SIZE = 17
+_LITERAL_LINE_FRAME_HEAD = b'G' + LITERAL_LINE_SIZE.to_bytes(2, 'little') + b'\x0f'
+
+def encode_raster_adaptive(data):
+    """ Like encode_raster_transfer(data), picking the smaller of PackBits and raw per line
+
+    The job stays in TIFF (rle) mode: a line is sent either PackBits compressed or
+    as one 17-byte literal packet, whichever is shorter, so dense noise and dither
+    never inflate past 17 bytes a line. PackBits can only beat the literal packet
+    on a line with at least two equal adjacent bytes (a 2-byte repeat packet already
+    saves a byte), so lines without such a pair skip the compressor. A line identical to the one before reuses its frame instead of
+    being compressed again. Yields one frame per line; the printer decodes every
+    frame to the same raster as encode_raster_transfer's.
+    """
+    import numpy as np
+    chunk_size = 16
+    view = memoryview(data).cast('B')
+    full = len(view) - len(view) % chunk_size
+    rows = np.frombuffer(view[:full], dtype=np.uint8).reshape(-1, chunk_size)
+    pack = ptcbp.COMPRESSIONS_TABLE['rle'][0]
+    zerofill = ptcbp.FRAMES['zerofill']
+
+    nonzero = rows.any(axis=1)
+    repeat = np.zeros(len(rows), dtype=bool)
+    repeat[1:] = (rows[1:] == rows[:-1]).all(axis=1)
+    has_pair = (rows[:, :-1] == rows[:, 1:]).any(axis=1)
+
+    frame = None
+    for i, (line_nonzero, line_repeat, line_has_pair) in enumerate(zip(nonzero.tolist(), repeat.tolist(), has_pair.tolist())):
+        if not line_nonzero:
+            frame = zerofill
+        elif not line_repeat:
+            line = bytes(view[i * chunk_size : (i + 1) * chunk_size])
+            payload = pack(line) if line_has_pair else None
+            if payload is not None and len(payload) < LITERAL_LINE_SIZE:
+                frame = b'G' + len(payload).to_bytes(2, 'little') + payload
+            else:
+                frame = _LITERAL_LINE_FRAME_HEAD + line
+        yield frame
+    if full != len(view):
+        yield ptcbp.serialize_data(bytes(view[full:]), 'rle')
+
+def encode_raster_lines(lines, nocomp=False):
+    """ Like encode_raster_transfer, for an iterable of 16-byte raster lines """
+    for line in lines:
+        yield from encode_raster_transfer(line, nocomp)
+
+def blank_runs(data):
+    """ Number of blank raster lines a 1bpp image starts and ends with, as (leading, trailing) """
+    import numpy as np
+    view = memoryview(data).cast('B')
+    full = len(view) - len(view) % 16
+    rows = np.frombuffer(view[:full], dtype=np.uint8).reshape(-1, 16)
+    inked = np.flatnonzero(rows.any(axis=1))
+    if len(inked) == 0:
+        return len(rows), len(rows)
+    # A partial last line is never trimmed
+    trailing = len(rows) - 1 - int(inked[-1]) if full == len(view) else 0
+    return int(inked[0]), trailing
+
+def raster_line_count(path):
+    """ Number of raster lines read_png_lines() will yield, read from the image header only """
+    from PIL import Image
+    with Image.open(path) as image:
+        # The image is rotated, so every source column becomes one raster line
+        return image.size[0]
+
+def read_png_lines(path, dither=True, strip=256):
+    """ Streaming read_png(path): yield the 16-byte raster lines one by one
+
+    The source is processed in strips of `strip` columns. Each strip goes through
+    the same invert/rotate/mirror/pad steps as read_png, so apart from the decoded
+    source only one strip worth of intermediate images is alive at a time. Error
+    diffusion runs along whole rows and would leave seams at strip boundaries, so
+    with dithering the source is converted to 1bpp in one go first. Output is
+    identical to read_png either way.
+    """
+    from PIL import Image, ImageOps
+    with Image.open(path) as image:
+        image.load()
+        if dither:
+            image = image.convert('1', dither=Image.FLOYDSTEINBERG)
+        w, h = image.size
+        x = (128-h)//2
+        for left in range(0, w, strip):
+            right = min(left + strip, w)
+            tmp = image.crop((left, 0, right, h))
+            tmp = tmp.convert('1', dither=Image.NONE)
+            tmp = ImageOps.invert(tmp.convert('L')).convert('1')
+            # rotate(-90) followed by a mirror is a transpose
+            tmp = tmp.transpose(Image.TRANSPOSE)
+            padded = Image.new('1', (128, right - left))
+            padded.paste(tmp, (x, 0, x+h, right - left))
+            buf = padded.tobytes()
+            for i in range(0, len(buf), 16):
+                yield buf[i : i + 16]
+
 def read_png(path, transform=True, padding=True, dither=True, data=None):
     """ Read a image and convert to 1bpp raw data
 
     This should work with any 8 bit PNG. To ensure compatibility, the image can
     be processed with Imagemagick first using the -monochrome flag.
     """
+    from PIL import Image, ImageOps
     if data:
         tmp = data
     else:
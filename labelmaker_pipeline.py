@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+# Pipelined print job runner
+#
+# Overlaps the stages labelmaker.py runs one after another: connecting and the
+# get_status handshake run on their own thread while the label renders, and
+# encoded frames flow through a bounded queue to a sender thread, so the first
+# raster lines are on the link while later ones are still being compressed.
+# Per-stage timings show which stage bounds throughput.
+
+import argparse
+import concurrent.futures
+import configparser
+import contextlib
+import os
+import queue
+import sys
+import threading
+import time
+
+import ptcbp
+import ptstatus
+import transport
+from characters import draw_text, draw_text_raster
+from labelmaker import configure_printer, query_ready_status, reset_printer
+from labelmaker_encode import encode_raster_lines, encode_raster_transfer, raster_line_count, read_png, read_png_lines
+
+DEFAULT_QUEUE_SIZE = 32
+# Frames are handed over in batches, one queue operation per raster line would cost more than it saves
+DEFAULT_BATCH_LINES = 64
+# Seconds between checks whether the other end of the queue gave up
+POLL_INTERVAL = 0.1
+# Busy times of encoder and sender closer than this (relative, absolute seconds) get no bottleneck verdict
+VERDICT_MARGIN = 0.2
+VERDICT_MIN_DIFF = 0.001
+
+class StageTimes(object):
+    """ Wall-clock spans per stage relative to the job start, plus accumulated wait times """
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans = {}
+        self.waits = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.spans[name] = (start - self.origin, time.perf_counter() - self.origin)
+
+    def wait(self, name, seconds):
+        with self._lock:
+            self.waits[name] = self.waits.get(name, 0.0) + seconds
+
+    def busy(self, name):
+        """ Seconds a stage spent working, its span minus the time it waited on the queue """
+        start, end = self.spans.get(name, (0.0, 0.0))
+        return end - start - self.waits.get(name, 0.0)
+
+    def report(self):
+        lines = [f'{"stage":<12}{"start s":>10}{"end s":>10}{"busy s":>10}']
+        for name, (start, end) in sorted(self.spans.items(), key=lambda kv: kv[1]):
+            lines.append(f'{name:<12}{start:>10.3f}{end:>10.3f}{self.busy(name):>10.3f}')
+        encode_blocked = self.waits.get('encode', 0.0)
+        send_starved = self.waits.get('send', 0.0)
+        lines.append(f'encoder blocked on a full queue: {encode_blocked:.3f}s, sender starved on an empty queue: {send_starved:.3f}s')
+        # Queue waits only show up once the queue fills or drains, busy times always tell which stage is slower
+        encode_busy, send_busy = self.busy('encode'), self.busy('send')
+        diff = abs(encode_busy - send_busy)
+        if diff > VERDICT_MIN_DIFF and diff > VERDICT_MARGIN * max(encode_busy, send_busy):
+            lines.append('=> throughput bound by ' + ('the link' if send_busy > encode_busy else 'encoding'))
+        return '\n'.join(lines)
+
+def _put(out, item, cancel):
+    """ Queue item, or give up and return False once the job is cancelled """
+    while not cancel.is_set():
+        try:
+            out.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(frames, cancel):
+    """ Next queued item, or None once the job is cancelled """
+    while not cancel.is_set():
+        try:
+            return frames.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return None
+
+def _encode_into(frames, out, times, batch_lines, cancel):
+    with times.stage('encode'):
+        try:
+            batch = []
+            for frame in frames:
+                batch.append(frame)
+                if len(batch) == batch_lines:
+                    start = time.perf_counter()
+                    if not _put(out, batch, cancel):
+                        return
+                    times.wait('encode', time.perf_counter() - start)
+                    batch = []
+            if batch:
+                _put(out, batch, cancel)
+        except BaseException:
+            cancel.set()
+            raise
+        finally:
+            _put(out, None, cancel)
+
+def _send_from(ser, frames, times, cancel):
+    with times.stage('send'):
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = _get(frames, cancel)
+                times.wait('send', time.perf_counter() - start)
+                if batch is None:
+                    break
+                ser.send(b''.join(batch), lines=len(batch))
+            if not cancel.is_set():
+                ser.flush()
+        except BaseException:
+            cancel.set()
+            raise
+
+def _connect(spec, times):
+    ser = transport.open_transport(spec)
+    with times.stage('connect'):
+        ser.connect()
+    with times.stage('handshake'):
+        status = query_ready_status(transport.BufferedSender(ser))
+    return ser, status
+
+def run_job(spec, render, args, raster_lines=None, queue_size=DEFAULT_QUEUE_SIZE, batch_lines=DEFAULT_BATCH_LINES):
+    """ Print one label with connection, rendering, encoding and sending overlapped
+
+    render() returns the 1bpp raster, or an iterator of raster lines when
+    raster_lines is given up front (streaming images). Returns the StageTimes.
+    """
+    times = StageTimes()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        connecting = pool.submit(_connect, spec, times)
+        try:
+            with times.stage('render'):
+                data = render()
+        except BaseException:
+            with contextlib.suppress(Exception):
+                connecting.result()[0].close()
+            raise
+        ser, status = connecting.result()
+
+        try:
+            if raster_lines is None:
+                raster_lines = len(data) // 16
+                frames = encode_raster_transfer(data, args.nocomp)
+            else:
+                frames = encode_raster_lines(data, args.nocomp)
+
+            out = transport.BufferedSender(ser)
+            with times.stage('configure'):
+                configure_printer(out, raster_lines, (status.tape_type, status.tape_width, status.tape_length),
+                                  compress=not args.nocomp, auto_cut=args.auto_cut, end_margin=args.end_margin)
+
+            # Set by whichever of encoder and sender fails, so the other one stops waiting on the queue
+            cancel = threading.Event()
+            handoff = queue.Queue(maxsize=queue_size)
+            sending = pool.submit(_send_from, out, handoff, times, cancel)
+            _encode_into(frames, handoff, times, batch_lines, cancel)
+            sending.result()
+
+            with times.stage('print'):
+                out.send(ptcbp.serialize_control('print'))
+                status = ptstatus.unpack_status(out.recv(32))
+                while status.status_type not in (0x01, 0x02):
+                    status = ptstatus.unpack_status(out.recv(32))
+            ptstatus.print_status(status)
+            print(f'=> Sent {out.bytes_sent} bytes in {out.writes} writes.')
+        finally:
+            # Don't let a dead link hide the error that ended the job
+            with contextlib.suppress(OSError):
+                reset_printer(ser)
+            ser.close()
+    return times
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Print a label with rendering, encoding and sending pipelined.')
+    p.add_argument('-t', '--transport', help='Printer transport spec. Defaults to the address in config.ini.')
+    p.add_argument('-l', '--label', help='String to print.')
+    p.add_argument('-i', '--image', help='Image file to print.')
+    p.add_argument('-v', '--vertical', help='Print in vertical.', action='store_true')
+    p.add_argument('-s', '--size', help='Font size.', type=int, default=0)
+    p.add_argument('-S', '--stream', help='Render the image strip by strip inside the pipeline.', action='store_true')
+    p.add_argument('-C', '--nocomp', help='Disable compression.', action='store_true')
+    p.add_argument('-a', '--auto-cut', help='Enable auto-cutting.', action='store_true')
+    p.add_argument('-m', '--end-margin', help='End margin (in dots).', default=0, type=int)
+    p.add_argument('-q', '--queue-size', help='Encoded batches buffered between encoder and sender.', type=int, default=DEFAULT_QUEUE_SIZE)
+    p.add_argument('--batch-lines', help='Raster lines per queued batch.', type=int, default=DEFAULT_BATCH_LINES)
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    conf = configparser.ConfigParser()
+    conf.read(os.path.join(os.path.dirname(__file__), "config.ini"))
+    spec = args.transport or conf.get('printer', 'address')
+    tape_width = conf.getint('printer', 'tape_width', fallback=12)
+
+    raster_lines = None
+    if args.label and args.vertical:
+        render = lambda: read_png(None, False, False, False, draw_text(args.label, vertical=True, fontsize=args.size, tape_width=tape_width))
+    elif args.label:
+        render = lambda: draw_text_raster(args.label, fontsize=args.size, tape_width=tape_width)
+    elif args.image and args.stream:
+        raster_lines = raster_line_count(args.image)
+        render = lambda: read_png_lines(args.image)
+    elif args.image:
+        render = lambda: read_png(args.image)
+    else:
+        print('** Nothing to print, give a label or an image.')
+        sys.exit(1)
+
+    times = run_job(spec, render, args, raster_lines, args.queue_size, args.batch_lines)
+    print(times.report())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# Per-job instrumentation
+#
+# JobMetrics collects stage timings (render, read_png, encode, connect, handshake,
+# transmit, completion) and counters (raster lines, zero lines, encoded and sent
+# bytes) for one print job and writes them as JSON or Prometheus text exposition.
+# Progress draws a progress line from the same counters, redrawn at most every
+# interval seconds instead of once per raster line.
+
+import collections
+import contextlib
+import json
+import sys
+import time
+
+import ptcbp
+
+PROMETHEUS_PREFIX = 'labelmaker'
+
+STAGES = ('render', 'read_png', 'encode', 'connect', 'handshake', 'transmit', 'completion')
+
+class JobMetrics(object):
+    """ Timings and counters of one job
+
+    Stage timings and counters are cheap and always collected. Timing the encoder
+    line by line and decoding pre-encoded streams for their zero-line count only
+    happen when enabled, i.e. when the metrics are going to be written out.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.timings = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self._origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def timed(self, name, iterable):
+        """ Iterate, charging the time spent producing each item to stage name """
+        if not self.enabled:
+            return iterable
+        return self._timed(name, iterable)
+
+    def _timed(self, name, iterable):
+        it = iter(iterable)
+        clock = time.perf_counter
+        spent = 0.0
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    spent += clock() - start
+                    return
+                spent += clock() - start
+                yield item
+        finally:
+            self.add_time(name, spent)
+
+    def count_frame(self, frame):
+        """ Account one raster line frame (G or Z) """
+        self.counters['raster_lines'] += 1
+        self.counters['encoded_bytes'] += len(frame)
+        if frame[0:1] == b'Z':
+            self.counters['zero_lines'] += 1
+
+    def count_stream(self, stream, lines):
+        """ Account pre-encoded raster frames for lines raster lines """
+        self.counters['raster_lines'] += lines
+        self.counters['encoded_bytes'] += len(stream)
+        if self.enabled:
+            self.counters['zero_lines'] += sum(1 for op in ptcbp.iter_ops(stream) if op.mnemonic == 'zerofill')
+
+    def collect_sender(self, sender):
+        """ Take the byte, write and transmit time counters of a transport.BufferedSender """
+        self.counters['bytes_sent'] += sender.bytes_sent
+        self.counters['writes'] += sender.writes
+        self.counters['flushes'] += sender.flushes
+        self.add_time('transmit', sender.send_seconds)
+
+    def report(self):
+        counters = dict(self.counters)
+        raster_bytes = counters.get('raster_lines', 0) * 16
+        encoded = counters.get('encoded_bytes', 0)
+        transmit = self.timings.get('transmit', 0.0)
+        return {
+            'stages': dict(self.timings),
+            'counters': counters,
+            'compression_ratio': raster_bytes / encoded if encoded else None,
+            'link_throughput': counters.get('bytes_sent', 0) / transmit if transmit else None,
+            'elapsed': time.perf_counter() - self._origin,
+        }
+
+    def prometheus(self):
+        report = self.report()
+        p = PROMETHEUS_PREFIX
+        lines = [f'# HELP {p}_stage_seconds Time spent in each job stage.',
+                 f'# TYPE {p}_stage_seconds gauge']
+        lines += [f'{p}_stage_seconds{{stage="{name}"}} {seconds:.6f}' for name, seconds in report['stages'].items()]
+        for name, value in sorted(report['counters'].items()):
+            lines += [f'# TYPE {p}_{name} gauge', f'{p}_{name} {value}']
+        for name in ('compression_ratio', 'link_throughput', 'elapsed'):
+            if report[name] is not None:
+                lines += [f'# TYPE {p}_{name} gauge', f'{p}_{name} {report[name]:.6f}']
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Write the report to path, as Prometheus text for .prom files and JSON otherwise """
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.report(), f, indent=2)
+                f.write('\n')
+
+class Progress(object):
+    """ Progress line for the raster transfer, redrawn from a JobMetrics' counters """
+    def __init__(self, metrics, total_lines, interval=0.1, width=40, out=None):
+        self.metrics = metrics
+        self.total_lines = total_lines
+        self.interval = interval
+        self.width = width
+        self.out = out if out is not None else sys.stdout
+        self._first_line = metrics.counters['raster_lines']
+        self._first_bytes = metrics.counters['encoded_bytes']
+        self._next_draw = 0.0
+
+    def update(self):
+        now = time.perf_counter()
+        if now >= self._next_draw:
+            self._next_draw = now + self.interval
+            self._draw()
+
+    def done(self):
+        self._draw()
+        self.out.write('\n')
+        self.out.flush()
+
+    def _draw(self):
+        lines = self.metrics.counters['raster_lines'] - self._first_line
+        encoded = self.metrics.counters['encoded_bytes'] - self._first_bytes
+        fraction = min(lines / self.total_lines, 1.0) if self.total_lines else 1.0
+        filled = int(fraction * self.width)
+        bar = '#' * filled + '-' * (self.width - filled)
+        self.out.write(f'\r[{bar}] {fraction:4.0%} {lines}/{self.total_lines} lines, {encoded} bytes')
+        self.out.flush()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Parallel batch pre-rendering
+#
+# Rendering (draw_text / read_png) and PackBits encoding are CPU-bound and run one
+# label at a time in labelmaker.py. This fans both out over a process pool and
+# collects the raster plus its encoded frames per label, in input order, ready to
+# be printed as one chained batch or written out as spool files for later.
+
+import argparse
+import concurrent.futures
+import configparser
+import contextlib
+import os
+import time
+
+import ptcbp
+import transport
+from labelmaker import do_batch_job, read_batch, render_job, reset_printer
+from labelmaker_encode import encode_raster_bulk
+from render_cache import CacheEntry
+from spool import write_spool
+
+def _render_one(item):
+    job, tape_width, nocomp = item
+    data, stream = render_job(job, tape_width, None, nocomp)
+    return CacheEntry(data, stream if stream is not None else encode_raster_bulk(data, nocomp))
+
+def prerender(jobs, tape_width, nocomp=False, workers=None):
+    """ Render and encode jobs (see labelmaker.read_batch) in parallel, results in input order """
+    workers = workers or os.cpu_count()
+    items = [(job, tape_width, nocomp) for job in jobs]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        # Hand out work in chunks, per-label round trips would dominate for short labels
+        chunksize = max(1, len(items) // (workers * 4))
+        return list(pool.map(_render_one, items, chunksize=chunksize))
+
+def write_spool_files(entries, directory, tape_dim, compress=True, auto_cut=False, end_margin=0):
+    """ Write every label as its own single-page spool file (see spool.py) """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, entry in enumerate(entries):
+        path = os.path.join(directory, f'{i:06d}.ptspool')
+        write_spool(path, [entry], tape_dim, compress, auto_cut, end_margin)
+        paths.append(path)
+    return paths
+
+def parse_args():
+    conf = configparser.ConfigParser()
+    conf.read(os.path.join(os.path.dirname(__file__), "config.ini"))
+
+    p = argparse.ArgumentParser(description='Render and encode a batch of labels in parallel.')
+    p.add_argument('-b', '--batch', help="CSV or JSON lines file with the labels ('-' for stdin).", required=True)
+    p.add_argument('-w', '--workers', help='Worker processes (default: one per CPU).', type=int)
+    p.add_argument('-o', '--spool-dir', help='Write one spool file per label here instead of printing.')
+    p.add_argument('-O', '--spool', help='Write all labels as one chained spool file instead of printing.')
+    p.add_argument('-t', '--transport', help='Printer transport spec. Defaults to the address in config.ini.', default=conf.get('printer', 'address', fallback=None))
+    p.add_argument('--tape-width', help='Tape width in mm.', type=int, default=conf.getint('printer', 'tape_width', fallback=12))
+    p.add_argument('-C', '--nocomp', help='Disable compression.', action='store_true')
+    p.add_argument('-a', '--auto-cut', help='Enable auto-cutting.', action='store_true')
+    p.add_argument('-m', '--end-margin', help='End margin (in dots).', default=0, type=int)
+    args = p.parse_args()
+    # do_batch_job sends through a BufferedSender configured from these
+    args.mtu = args.flush_bytes = transport.DEFAULT_MTU
+    args.flush_lines = None
+    args.flush_at_end = False
+    # Feed after the last label like a single print does
+    args.no_feed = False
+    return args
+
+def main():
+    args = parse_args()
+    jobs = read_batch(args.batch)
+
+    start = time.perf_counter()
+    entries = prerender(jobs, args.tape_width, args.nocomp, args.workers)
+    elapsed = time.perf_counter() - start
+    encoded = sum(len(e.stream) for e in entries)
+    print(f'=> Rendered {len(entries)} labels in {elapsed:.2f}s ({len(entries) / elapsed:.0f} labels/s, {encoded} encoded bytes)')
+
+    tape_dim = (ptcbp.MediaType.laminated, args.tape_width, 0)
+    if args.spool_dir:
+        paths = write_spool_files(entries, args.spool_dir, tape_dim, not args.nocomp, args.auto_cut, args.end_margin)
+        print(f'=> Wrote {len(paths)} spool files to {args.spool_dir}')
+        return
+    if args.spool:
+        index = write_spool(args.spool, entries, tape_dim, not args.nocomp, args.auto_cut, args.end_margin)
+        print(f'=> Wrote {len(index)} pages to {args.spool}')
+        return
+
+    with contextlib.closing(transport.open_transport(args.transport)) as ser:
+        ser.connect()
+        try:
+            do_batch_job(ser, args, entries)
+        finally:
+            reset_printer(ser)
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,10 @@
 import io
 import struct
 import enum
+import functools
+import mmap
 from collections import namedtuple
-from typing import BinaryIO, Optional, Union
+from typing import BinaryIO, Iterator, List, Optional, Union
 
 import packbits
 
@@ -44,6 +46,9 @@ def _build_op_tree() -> dict:
 
 OPS = _build_op_tree()
 
+# Precompiled little-endian parameter layouts, keyed by mnemonic
+PARAM_STRUCTS = {e[1]: struct.Struct(f'<{e[2]}') for e in CMD_SCHEMA if e[2] is not None}
+
 PrintParameters = namedtuple('PrintParameters', ('active_fields', 'media_type', 'width_mm', 'length_mm', 'length_px', 'is_follow_up', 'sbz'))
 
 class CompressionType(enum.IntEnum):
@@ -122,7 +127,7 @@ class Opcode(object):
             self.op = op
         if paramschema is None:
             op_bytes = bytes(self.op)
-            self.paramschema = struct.Struct(f'<{OPS_FLAT[op_bytes][2]}') if op_bytes in OPS_FLAT and OPS_FLAT[op_bytes][2] is not None else None
+            self.paramschema = PARAM_STRUCTS.get(OPS_FLAT[op_bytes][1]) if op_bytes in OPS_FLAT else None
         else:
             self.paramschema = struct.Struct(f'<{paramschema}') if paramschema is not None else None
 
@@ -213,12 +218,35 @@ class Opcode(object):
         buf = io.BytesIO(ptcbp_bytes)
         return cls.deserialize(buf, data_compress)
 
+# Frame cache
+# Parameterless frames never change, so they are serialized once at import.
+FRAMES = {e[1]: e[0] for e in CMD_SCHEMA if e[2] is None and e[3] is None}
+
+FRAME_CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize=FRAME_CACHE_SIZE)
+def _serialize_control_cached(mnemonic: str, params) -> bytes:
+    return Opcode(op_mnemonic=mnemonic, params=params).serialize_as_bytes()
+
+def _serialize_control(mnemonic: str, params) -> bytes:
+    if params is None and mnemonic in FRAMES:
+        return FRAMES[mnemonic]
+    try:
+        return _serialize_control_cached(mnemonic, params)
+    except TypeError:
+        # Unhashable params (e.g. a list), skip the cache
+        return Opcode(op_mnemonic=mnemonic, params=params).serialize_as_bytes()
+
+def frame_cache_info():
+    """ Hit/miss statistics of the parameterized frame cache """
+    return _serialize_control_cached.cache_info()
+
 # Simplified API
 def serialize_control(mnemonic: str, *params) -> bytes:
-    return Opcode(op_mnemonic=mnemonic, params=params or None).serialize_as_bytes()
+    return _serialize_control(mnemonic, params or None)
 
 def serialize_control_obj(mnemonic, params=None):
-    return Opcode(op_mnemonic=mnemonic, params=params).serialize_as_bytes()
+    return _serialize_control(mnemonic, params)
 
 def serialize_data(data, compress='none', use_data2=False):
     if use_data2 and compress == 'none':
@@ -227,3 +255,164 @@ def serialize_data(data, compress='none', use_data2=False):
     else:
         mnemonic = 'data'
     return Opcode(op_mnemonic=mnemonic, data=Data(data, compress=compress)).serialize_as_bytes()
+
+# Zero-copy stream parser
+class OpRecord(namedtuple('OpRecord', ('offset', 'op', 'mnemonic', 'params', 'payload', 'compression'))):
+    """ A parsed opcode. payload is a memoryview slice of the parsed buffer, not a copy. """
+    __slots__ = ()
+
+    @property
+    def data(self) -> Optional[bytes]:
+        """ Payload with the active compression undone, decoded only when accessed """
+        if self.payload is None:
+            return None
+        return COMPRESSIONS_TABLE[self.compression][1](self.payload)
+
+def _parse_one(buf: memoryview, pos: int, end: int, base: int=0):
+    """ Parse the opcode at buf[pos:end]. base is added to positions in error messages.
+
+    Returns (schema_entry, params, payload, next_pos). If the buffer ends early,
+    schema_entry is None and the last element is the minimum number of bytes
+    (counted from pos) needed to make progress.
+    """
+    level = OPS
+    i = pos
+    while True:
+        if i >= end:
+            return None, None, None, i - pos + 1
+        entry = level.get(buf[i])
+        if entry is None:
+            raise ValueError(f'Unknown byte 0x{buf[i]:02x} at position {base + i:d}')
+        i += 1
+        if not isinstance(entry, dict):
+            break
+        level = entry
+    params = None
+    schema = PARAM_STRUCTS.get(entry[1])
+    if schema is not None:
+        if i + schema.size > end:
+            return None, None, None, i + schema.size - pos
+        params = schema.unpack_from(buf, i)
+        i += schema.size
+    payload = None
+    if entry[3] is not None:
+        data_len = entry[3][0](params)
+        if i + data_len > end:
+            return None, None, None, i + data_len - pos
+        payload = buf[i:i + data_len]
+        i += data_len
+    return entry, params, payload, i
+
+class StreamParser(object):
+    """ Incremental PTCBP parser that accepts arbitrary chunk boundaries.
+
+    Only an opcode straddling two chunks is copied; every other payload is a
+    slice of the chunk it arrived in. The active compression is tracked from
+    'compression' opcodes in the stream so data records decode correctly.
+    """
+    def __init__(self, compression: str='none') -> None:
+        if compression not in COMPRESSIONS_TABLE:
+            raise ValueError(f'Unknown compression type {compression}')
+        self.compression = compression
+        self.offset = 0
+        self._pending = bytearray()
+
+    def _record(self, entry, params, payload, offset) -> OpRecord:
+        if entry[1] == 'compression':
+            ctype = params[0]
+            if ctype >= len(COMPRESSIONS) or COMPRESSIONS[ctype] is None:
+                raise ValueError(f'Unknown compression type {ctype} at position {offset:d}')
+            self.compression = COMPRESSIONS[ctype][0]
+        return OpRecord(offset, entry[0], entry[1], params, payload, self.compression)
+
+    def _feed_pending(self, view: memoryview, records: List[OpRecord]) -> int:
+        pos = 0
+        while True:
+            pending = bytes(self._pending)
+            entry, params, payload, nxt = _parse_one(memoryview(pending), 0, len(pending), self.offset)
+            if entry is not None:
+                break
+            take = nxt - len(pending)
+            if pos + take > len(view):
+                self._pending += view[pos:]
+                return len(view)
+            self._pending += view[pos:pos + take]
+            pos += take
+        records.append(self._record(entry, params, payload, self.offset))
+        self.offset += nxt
+        self._pending = bytearray()
+        return pos
+
+    def feed(self, chunk) -> List[OpRecord]:
+        """ Parse as many complete opcodes as possible, keeping the remainder for the next call
+
+        Payloads reference chunk directly, so it must not be modified afterwards.
+        """
+        view = memoryview(chunk).cast('B')
+        records = []
+        pos = 0
+        if self._pending:
+            pos = self._feed_pending(view, records)
+            if self._pending:
+                return records
+        end = len(view)
+        while pos < end:
+            entry, params, payload, nxt = _parse_one(view, pos, end, self.offset - pos)
+            if entry is None:
+                self._pending = bytearray(view[pos:])
+                break
+            records.append(self._record(entry, params, payload, self.offset))
+            self.offset += nxt - pos
+            pos = nxt
+        return records
+
+    def close(self) -> None:
+        """ Signal end of stream. Raises if an opcode was cut short. """
+        if self._pending:
+            raise IOError('Unexpected end of stream')
+
+def iter_ops(buf, compression: str='none') -> Iterator[OpRecord]:
+    """ Parse a complete in-memory PTCBP stream (bytes, memoryview, mmap, ...) """
+    view = memoryview(buf).cast('B')
+    parser = StreamParser(compression)
+    pos = 0
+    end = len(view)
+    while pos < end:
+        entry, params, payload, nxt = _parse_one(view, pos, end)
+        if entry is None:
+            raise IOError('Unexpected end of stream')
+        yield parser._record(entry, params, payload, pos)
+        pos = nxt
+
+def split_frames(buf, size: int) -> Iterator[memoryview]:
+    """ Slice a PTCBP stream into chunks of at most size bytes that end on opcode boundaries
+
+    Lets other frames (e.g. get_status) be interleaved between chunks safely. An
+    opcode longer than size is yielded as a chunk of its own.
+    """
+    view = memoryview(buf).cast('B')
+    start = pos = 0
+    end = len(view)
+    while pos < end:
+        entry, _, _, nxt = _parse_one(view, pos, end)
+        if entry is None:
+            raise IOError('Unexpected end of stream')
+        if nxt - start > size and pos > start:
+            yield view[start:pos]
+            start = pos
+        pos = nxt
+    if start < end:
+        yield view[start:end]
+
+def parse_file(path: str, compression: str='none') -> Iterator[OpRecord]:
+    """ Parse a captured job file through mmap without reading it into memory """
+    with open(path, 'rb') as f:
+        if f.seek(0, io.SEEK_END) == 0:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    yield from iter_ops(mm, compression)
+    try:
+        mm.close()
+    except BufferError:
+        # Some payload slices are still referenced; the mapping goes away with them
+        pass
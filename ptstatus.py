@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 
 import ctypes
+import struct
 import sys
 import contextlib
-import bluetooth
+from collections import namedtuple
 import ptcbp
 
 POWER = {
@@ -131,6 +132,8 @@ NOTIFICATIONS = {
 }
 
 class StatusRegister(ctypes.BigEndianStructure):
+    # The wire format is 32 bytes with hw_settings at offset 26, so no alignment padding
+    _pack_ = 1
     _fields_ = (
         ('magic', ctypes.c_char * 4),
         ('model', ctypes.c_uint8),
@@ -215,16 +218,138 @@ def print_status(stat, verbose=False):
     if (verbose):
         print(f'Hardware settings: 0x{stat.hw_settings:08x}')
 
+# Fast status record
+# Same layout as StatusRegister, decoded with one precompiled struct into an
+# immutable tuple. Attribute names match StatusRegister, so print_status and
+# everything reading status fields accepts either.
+_STATUS_STRUCT = struct.Struct('>4s4BH8B2B H4B I2s')
+
+class Status(namedtuple('Status', ('magic', 'model', 'country', 'err2', 'power', 'err',
+                                   'tape_width', 'tape_type', 'colors', 'fonts', 'sbz0', 'mode', 'density', 'tape_length',
+                                   'status_type', 'phase_type', 'phase', 'notification', 'expansion_area',
+                                   'tape_bgcolor', 'tape_fgcolor', 'hw_settings', 'sbz1'))):
+    __slots__ = ()
+
+    @classmethod
+    def from_bytes(cls, bytes_):
+        # tuple.__new__ directly, _make() adds a length check the struct already guarantees
+        return tuple.__new__(cls, _STATUS_STRUCT.unpack(bytes_))
+
+    def __bytes__(self):
+        return _STATUS_STRUCT.pack(*self)
+
+    # StatusRegister names
+    @property
+    def _err2(self):
+        return self.err2
+
+    @property
+    def _power(self):
+        return self.power
+
 def unpack_status(bytes_):
     if len(bytes_) != 32:
         raise ValueError('Status must be exactly 32 bytes long.')
-    status = StatusRegister()
-    ctypes.memmove(ctypes.addressof(status), bytes_, ctypes.sizeof(status))
-    return status
+    return Status.from_bytes(bytes_)
+
+# Status change events
+class ErrorEvent(namedtuple('ErrorEvent', ('bit', 'active'))):
+    """ An ERR_FLAGS bit was raised or cleared """
+    __slots__ = ()
+
+    def __str__(self):
+        return f'Error {"raised" if self.active else "cleared"}: {ERR_FLAGS.get(self.bit, f"bit{self.bit}")}'
+
+class PhaseEvent(namedtuple('PhaseEvent', ('old', 'new'))):
+    """ Phase transition, phases are (phase_type << 16 | phase) as in PHASES """
+    __slots__ = ()
+
+    def __str__(self):
+        return f'Phase: {describe_code(self.new, PHASES)}'
+
+class NotificationEvent(namedtuple('NotificationEvent', ('code',))):
+    """ Cover opened or closed """
+    __slots__ = ()
+
+    def __str__(self):
+        return f'Notification: {describe_code(self.code, NOTIFICATIONS)}'
+
+class PowerEvent(namedtuple('PowerEvent', ('old', 'new'))):
+    """ Battery level or AC change, see POWER """
+    __slots__ = ()
+
+    def __str__(self):
+        return f'Power: {describe_code(self.new, POWER)}'
+
+class FieldEvent(namedtuple('FieldEvent', ('field', 'old', 'new'))):
+    """ Any other watched status field changed """
+    __slots__ = ()
+
+    def __str__(self):
+        table = _FIELD_TABLES.get(self.field)
+        return f'{self.field}: {describe_code(self.new, table) if table else self.new}'
+
+WATCHED_FIELDS = ('model', 'tape_width', 'tape_type', 'tape_length', 'mode', 'status_type', 'tape_bgcolor', 'tape_fgcolor')
+_FIELD_TABLES = {'model': MODELS, 'tape_type': TAPE_TYPE, 'status_type': STATUS_TYPE,
+                 'tape_bgcolor': TAPE_BGCOLORS, 'tape_fgcolor': TAPE_FGCOLORS}
+
+class StatusMonitor(object):
+    """ Turns successive 32-byte status frames into events for what changed
+
+    The first frame reports the full state: active errors, phase, power and every
+    watched field. Frames identical to the previous one cost a bytes comparison.
+    """
+    def __init__(self):
+        self.status = None
+        self._raw = None
+
+    def feed(self, frame):
+        frame = bytes(frame)
+        if frame == self._raw:
+            return []
+        new = unpack_status(frame)
+        old = self.status
+        self._raw, self.status = frame, new
+
+        events = []
+        old_err = old.err if old is not None else 0
+        changed = old_err ^ new.err
+        bit = 0
+        while changed:
+            if changed & 1:
+                events.append(ErrorEvent(bit, bool(new.err >> bit & 1)))
+            changed >>= 1
+            bit += 1
+
+        old_phase = old.phase_type << 16 | old.phase if old is not None else None
+        new_phase = new.phase_type << 16 | new.phase
+        if new_phase != old_phase:
+            events.append(PhaseEvent(old_phase, new_phase))
+
+        if new.notification and (old is None or new.notification != old.notification):
+            events.append(NotificationEvent(new.notification))
+
+        if old is None or new.power != old.power:
+            events.append(PowerEvent(old.power if old is not None else None, new.power))
+
+        for field in WATCHED_FIELDS:
+            value = getattr(new, field)
+            if old is None or value != getattr(old, field):
+                events.append(FieldEvent(field, getattr(old, field) if old is not None else None, value))
+        return events
+
+def status_events(frames):
+    """ Yield the events of every status frame in turn """
+    monitor = StatusMonitor()
+    for frame in frames:
+        yield from monitor.feed(frame)
 
 if __name__ == '__main__':
+    # Only the command line talks to a printer, the decoder needs no transport
+    import transport
+
     if len(sys.argv) < 2:
-        print(f'Usage: {sys.argv[0]} <addr> [ch]')
+        print(f'Usage: {sys.argv[0]} <addr|transport spec> [ch]')
         exit(1)
 
     addr = sys.argv[1]
@@ -233,13 +358,11 @@ if __name__ == '__main__':
     else:
         ch = int(sys.argv[2])
 
-    with contextlib.closing(bluetooth.BluetoothSocket(bluetooth.RFCOMM)) as sock:
-        sock.connect((addr, ch))
+    with contextlib.closing(transport.open_transport(addr, ch)) as sock:
+        sock.connect()
         sock.send(b'\x00'*64)
         sock.send(ptcbp.serialize_control('reset'))
         sock.send(ptcbp.serialize_control('get_status'))
-        resp = StatusRegister()
         buf = sock.recv(32)
-        ctypes.memmove(ctypes.addressof(resp), buf, ctypes.sizeof(resp))
         print(buf)
-        print_status(resp, verbose=True)
+        print_status(unpack_status(buf), verbose=True)
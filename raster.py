@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# NumPy image preprocessing
+#
+# Fused replacement for the PIL pass chain in read_png (dither, 1 -> L -> invert -> 1,
+# rotate, mirror, pad): the image is thresholded straight to an ink mask, transposed,
+# centred in the 128-dot head and packed with np.packbits into the row layout
+# encode_raster_transfer expects.
+
+import numpy as np
+from PIL import Image
+
+from labelmaker_encode import DITHERS
+
+HEAD_DOTS = 128
+
+# 8x8 Bayer index matrix
+_BAYER2 = np.array([[0, 2], [3, 1]])
+def _bayer(n):
+    m = _BAYER2
+    while m.shape[0] < n:
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return m
+BAYER8 = _bayer(8)
+# Per-cell grey thresholds, a pixel below its threshold gets a dot
+_BAYER8_THRESHOLDS = ((BAYER8 + 0.5) * (256 / BAYER8.size)).astype(np.uint8)
+
+def ink_mask(image, dither='threshold'):
+    """ Boolean (height, width) array, True where the printer should put a dot (dark pixels) """
+    if dither == 'floyd-steinberg':
+        # Error diffusion is inherently serial, let PIL do it
+        return ~np.asarray(image.convert('1', dither=Image.FLOYDSTEINBERG), dtype=bool)
+    if dither == 'threshold':
+        # PIL cuts colour at unrounded luma, not at the rounded convert('L') value, let it do that too
+        return ~np.asarray(image.convert('1', dither=Image.NONE), dtype=bool)
+    elif dither == 'bayer':
+        gray = np.asarray(image.convert('L'))
+        h, w = gray.shape
+        reps = (-(-h // 8), -(-w // 8))
+        return gray < np.tile(_BAYER8_THRESHOLDS, reps)[:h, :w]
+    raise ValueError(f'Unknown dither {dither}, expected one of {", ".join(DITHERS)}')
+
+def pack_mask(mask, transform=True, padding=True):
+    """ Transpose (rotate -90 + mirror), centre in HEAD_DOTS and pack to 1bpp rows """
+    if transform:
+        mask = mask.T
+    if padding:
+        lines, w = mask.shape
+        x = (HEAD_DOTS - w) // 2
+        padded = np.zeros((lines, HEAD_DOTS), dtype=bool)
+        # Clip like Image.paste does when the image is wider than the head
+        src0, dst0 = max(0, -x), max(0, x)
+        n = min(w - src0, HEAD_DOTS - dst0)
+        padded[:, dst0:dst0 + n] = mask[:, src0:src0 + n]
+        mask = padded
+    return np.packbits(mask, axis=1).tobytes()
+
+def read_png_fast(path, dither='threshold', transform=True, padding=True):
+    """ read_png with the preprocessing done in NumPy
+
+    'floyd-steinberg' gives exactly read_png(path) and 'threshold' exactly
+    read_png(path, dither=False). 'bayer' is an 8x8 ordered dither, much faster
+    than error diffusion and free of its worm artifacts on text and QR content.
+    """
+    with Image.open(path) as image:
+        return pack_mask(ink_mask(image, dither), transform, padding)
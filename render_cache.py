@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# Content-addressed cache of rendered labels
+#
+# Entries hold the final 1bpp raster (what read_png returns) and the encoded
+# PTCBP raster frames (what encode_raster_bulk returns), keyed by a hash of
+# everything that went into rendering them. Recently used entries stay in memory,
+# everything is also written to a directory that is trimmed to a size budget.
+
+import collections
+import hashlib
+import json
+import os
+import struct
+import threading
+
+from labelmaker_encode import encode_raster_bulk
+
+# Bump when rendering or encoding changes so stale entries are never served
+CACHE_VERSION = 2
+
+CacheEntry = collections.namedtuple('CacheEntry', ('raster', 'stream'))
+
+_ENTRY_HEADER = struct.Struct('<4sI')
+_ENTRY_MAGIC = b'LMRC'
+
+def _digest(params, blob=b''):
+    h = hashlib.sha256()
+    h.update(json.dumps([CACHE_VERSION, params], sort_keys=True).encode())
+    h.update(blob)
+    return h.hexdigest()
+
+def text_key(text, fontfile, fontsize, vertical, tape_width, nocomp=False):
+    return _digest({'kind': 'text', 'text': text, 'font': fontfile, 'size': fontsize,
+                    'vertical': bool(vertical), 'tape_width': str(tape_width), 'nocomp': bool(nocomp)})
+
+def image_key(image_bytes, transform=True, padding=True, dither=True, nocomp=False):
+    return _digest({'kind': 'image', 'transform': transform, 'padding': padding,
+                    'dither': dither, 'nocomp': bool(nocomp)}, image_bytes)
+
+def barcode_key(kind, value, module=None, caption=False, nocomp=False):
+    return _digest({'kind': kind, 'value': value, 'module': module, 'caption': bool(caption), 'nocomp': bool(nocomp)})
+
+def template_key(spec, assets=b'', nocomp=False):
+    """ Key of the static part of a label template, assets are the bytes of its images """
+    return _digest({'kind': 'template', 'spec': spec, 'nocomp': bool(nocomp)}, assets)
+
+class RenderCache(object):
+    def __init__(self, directory=None, max_memory=32 << 20, max_disk=256 << 20):
+        self.directory = directory
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def stats(self):
+        return {'hits_memory': self.hits_memory, 'hits_disk': self.hits_disk, 'misses': self.misses,
+                'memory_entries': len(self._memory), 'memory_bytes': self._memory_size}
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.lmrc')
+
+    def _remember(self, key, entry):
+        size = len(entry.raster) + len(entry.stream)
+        if size > self.max_memory:
+            return
+        if key in self._memory:
+            return
+        self._memory[key] = entry
+        self._memory_size += size
+        while self._memory_size > self.max_memory:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= len(old.raster) + len(old.stream)
+
+    def _load(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                blob = f.read()
+        except FileNotFoundError:
+            return None
+        if len(blob) < _ENTRY_HEADER.size:
+            return None
+        magic, raster_len = _ENTRY_HEADER.unpack_from(blob)
+        if magic != _ENTRY_MAGIC or _ENTRY_HEADER.size + raster_len > len(blob):
+            return None
+        start = _ENTRY_HEADER.size
+        # Mark as recently used for eviction
+        os.utime(self._path(key))
+        return CacheEntry(blob[start:start + raster_len], blob[start + raster_len:])
+
+    def _store(self, key, entry):
+        # Write to a temporary file first so readers never see half an entry
+        import tempfile
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_ENTRY_HEADER.pack(_ENTRY_MAGIC, len(entry.raster)))
+            f.write(entry.raster)
+            f.write(entry.stream)
+        os.replace(tmp, self._path(key))
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = []
+        total = 0
+        for e in os.scandir(self.directory):
+            if e.name.endswith('.lmrc'):
+                st = e.stat()
+                files.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_disk:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return entry
+            if self.directory is not None:
+                entry = self._load(key)
+                if entry is not None:
+                    self._remember(key, entry)
+                    self.hits_disk += 1
+                    return entry
+            self.misses += 1
+            return None
+
+    def put(self, key, raster, stream):
+        entry = CacheEntry(bytes(raster), bytes(stream))
+        with self._lock:
+            self._remember(key, entry)
+            if self.directory is not None:
+                self._store(key, entry)
+        return entry
+
+    def get_or_render(self, key, render, nocomp=False):
+        """ Return the cached entry for key, or call render() for the raster and cache it """
+        entry = self.get(key)
+        if entry is None:
+            raster = render()
+            entry = self.put(key, raster, encode_raster_bulk(raster, nocomp))
+        return entry
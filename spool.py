@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Spool files: fully encoded jobs saved for later replay
+#
+# Layout (little endian):
+#   header   magic, version, tape type/width/length, compression, flags,
+#            end margin, page count, body offset
+#   index    per page: offset and length of its raster frames in the body,
+#            raster line count
+#   body     the exact PTCBP stream labelmaker.send_pages() sends after the
+#            status handshake: configure frames, G/Z raster frames, print_page
+#            between pages and print at the end
+#
+# Replay mmaps the file and streams slices of the body straight to the transport.
+# A single page can be reprinted on its own: fresh configure frames are built for
+# it and its raster frames are sent from the mapping.
+
+import argparse
+import collections
+import configparser
+import contextlib
+import mmap
+import os
+import struct
+import sys
+
+import ptcbp
+import transport
+from labelmaker import configure_printer, encode_job, query_ready_status, reset_printer, wait_pages_completed
+
+MAGIC = b'PTSPOOL\x00'
+VERSION = 1
+FLAG_AUTO_CUT = 1 << 0
+
+_HEADER = struct.Struct('<8sHBBBBBxHIQ')
+_INDEX_ENTRY = struct.Struct('<QQI')
+
+PageIndex = collections.namedtuple('PageIndex', ('offset', 'length', 'raster_lines'))
+
+RASTER_OPS = ('data', 'data2', 'zerofill')
+PAGE_END_OPS = ('print', 'print_page')
+
+def _index_pages(stream):
+    """ Locate every page's raster frames in a job stream """
+    pages = []
+    start = lines = None
+    for record in ptcbp.iter_ops(stream):
+        if record.mnemonic in RASTER_OPS:
+            if start is None:
+                start, lines = record.offset, 0
+            lines += 1
+        elif record.mnemonic in PAGE_END_OPS:
+            if start is None:
+                # Empty page
+                start, lines = record.offset, 0
+            pages.append(PageIndex(start, record.offset - start, lines))
+            start = None
+    return pages
+
+def write_spool(path, pages, tape_dim, compress=True, auto_cut=False, end_margin=0):
+    """ Encode pages (render_cache.CacheEntry list) as one chained job and save it with its index """
+    body = encode_job(pages, tape_dim, compress, auto_cut, end_margin)
+    index = _index_pages(body)
+    tape_type, tape_width, tape_length = tape_dim
+    compression = ptcbp.CompressionType.rle if compress else ptcbp.CompressionType.none
+    body_offset = _HEADER.size + _INDEX_ENTRY.size * len(index)
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, tape_type, tape_width, tape_length, compression,
+                             FLAG_AUTO_CUT if auto_cut else 0, end_margin, len(index), body_offset))
+        for entry in index:
+            f.write(_INDEX_ENTRY.pack(*entry))
+        f.write(body)
+    return index
+
+class Spool(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self):
+        if len(self._view) < _HEADER.size:
+            raise ValueError(f'{self.path} is not a spool file')
+        (magic, version, tape_type, tape_width, tape_length, compression,
+         flags, end_margin, count, body_offset) = _HEADER.unpack_from(self._view)
+        if magic != MAGIC:
+            raise ValueError(f'{self.path} is not a spool file')
+        if version != VERSION:
+            raise ValueError(f'Unsupported spool version {version}')
+        if body_offset != _HEADER.size + _INDEX_ENTRY.size * count or body_offset > len(self._view):
+            raise ValueError(f'{self.path} has a corrupt index')
+        self.tape_dim = (tape_type, tape_width, tape_length)
+        self.compression = ptcbp.CompressionType(compression)
+        self.auto_cut = bool(flags & FLAG_AUTO_CUT)
+        self.end_margin = end_margin
+        self.pages = [PageIndex(*_INDEX_ENTRY.unpack_from(self._view, _HEADER.size + i * _INDEX_ENTRY.size))
+                      for i in range(count)]
+        self.body = self._view[body_offset:]
+
+    def close(self):
+        self.body = None
+        self._view.release()
+        try:
+            self._mm.close()
+        except BufferError:
+            # page() views still held by the caller keep the mapping alive, it is unmapped with the last of them
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.pages)
+
+    def page(self, i):
+        """ Raster frames of page i, a slice of the mapping that stays valid after close() """
+        entry = self.pages[i]
+        return self.body[entry.offset:entry.offset + entry.length]
+
+    def page_job(self, i):
+        """ Buffers that print page i on its own: configure frames, raster frames, print """
+        head = transport.FrameBuffer()
+        configure_printer(head, self.pages[i].raster_lines, self.tape_dim,
+                          compress=self.compression == ptcbp.CompressionType.rle,
+                          auto_cut=self.auto_cut, end_margin=self.end_margin)
+        return [head, self.page(i), ptcbp.serialize_control('print')]
+
+    def replay(self, conn, page=None, mtu=transport.DEFAULT_MTU):
+        """ Send the whole job, or only the given page, to a connected transport. Returns the number of writes. """
+        buffers = [self.body] if page is None else self.page_job(page)
+        return sum(transport.send_all(conn, buf, mtu) for buf in buffers)
+
+def parse_args():
+    conf = configparser.ConfigParser()
+    conf.read(os.path.join(os.path.dirname(__file__), "config.ini"))
+
+    p = argparse.ArgumentParser(description='Inspect and replay spool files.')
+    sub = p.add_subparsers(dest='command', required=True)
+    info = sub.add_parser('info', help='Show the spool header and page index.')
+    info.add_argument('spool')
+    replay = sub.add_parser('replay', help='Send a spooled job to the printer.')
+    replay.add_argument('spool')
+    replay.add_argument('-p', '--page', help='Reprint only this page (0-based).', type=int)
+    replay.add_argument('-t', '--transport', help='Printer transport spec. Defaults to the address in config.ini.', default=conf.get('printer', 'address', fallback=None))
+    replay.add_argument('--mtu', help='Largest single write to the transport, in bytes.', type=int, default=transport.DEFAULT_MTU)
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    with Spool(args.spool) as spool:
+        if args.command == 'info':
+            tape_type, tape_width, tape_length = spool.tape_dim
+            print(f'Pages: {len(spool)}, tape: {tape_width}mm type 0x{tape_type:02x} length {tape_length}mm, '
+                  f'compression: {spool.compression.name}, body: {len(spool.body)} bytes')
+            for i, entry in enumerate(spool.pages):
+                print(f'  page {i}: {entry.raster_lines} lines, {entry.length} bytes at {entry.offset}')
+            return
+
+        if args.page is not None and not 0 <= args.page < len(spool):
+            print(f'** No page {args.page}, the spool has pages 0 to {len(spool) - 1}.')
+            sys.exit(1)
+        with contextlib.closing(transport.open_transport(args.transport)) as ser:
+            print('=> Connecting to printer...')
+            ser.connect()
+            try:
+                status = query_ready_status(ser)
+                if status.tape_width != spool.tape_dim[1]:
+                    print(f'** Spool was encoded for {spool.tape_dim[1]}mm tape but {status.tape_width}mm is loaded.')
+                    sys.exit(1)
+                writes = spool.replay(ser, args.page, args.mtu)
+                pages = len(spool) if args.page is None else 1
+                print(f'=> Sent {pages} pages in {writes} writes.')
+                wait_pages_completed(ser, pages)
+            finally:
+                reset_printer(ser)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# Label templates
+#
+# A template is a JSON file declaring the label length, static artwork (text,
+# images, boxes) and named variable fields:
+#
+#   {"length": 400,
+#    "elements": [
+#      {"box": [0, 0, 400, 128], "width": 2},
+#      {"image": "logo.png", "x": 8, "y": 8},
+#      {"text": "S/N", "x": 120, "y": 10, "size": 24},
+#      {"field": "serial", "x": 120, "y": 50, "size": 48}]}
+#
+# x counts raster lines along the tape and y head dots across it, the way
+# read_png lays an image out (image x -> raster line, image y -> head dot).
+# The static part is rasterized and encoded once. Per label only the raster lines
+# covered by the rendered fields are redrawn and encoded, all other lines are
+# sliced out of the cached static frames. Field lines are memoized by content, so
+# in a serial number run only the lines of the digits that changed get encoded.
+
+import argparse
+import configparser
+import contextlib
+import functools
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageOps
+
+import ptcbp
+import transport
+from characters import text_mask
+from labelmaker import do_batch_job, read_batch, reset_printer
+from labelmaker_encode import encode_raster_bulk
+from raster import HEAD_DOTS, ink_mask
+from render_cache import CacheEntry, template_key
+from spool import write_spool
+
+DEFAULT_SIZE = 30
+# Encoded frames of recently seen field lines kept per template
+FRAME_MEMO_SIZE = 1 << 16
+
+def _blit(canvas, mask, x, y):
+    """ OR a (lines, dots) mask into canvas at raster line x, head dot y, clipped. Returns the line range touched. """
+    lines, dots = mask.shape
+    sx, sy = max(0, -x), max(0, -y)
+    dx, dy = max(0, x), max(0, y)
+    n = min(lines - sx, canvas.shape[0] - dx)
+    m = min(dots - sy, canvas.shape[1] - dy)
+    if n <= 0 or m <= 0:
+        return dx, dx
+    canvas[dx:dx + n, dy:dy + m] |= mask[sx:sx + n, sy:sy + m]
+    return dx, dx + n
+
+def _box(canvas, x, y, lines, dots, width=1, fill=False):
+    mask = np.ones((lines, dots), dtype=bool)
+    if not fill:
+        mask[width:lines - width, width:dots - width] = False
+    _blit(canvas, mask, x, y)
+
+def _merge(ranges):
+    """ Sorted, non-overlapping version of a list of (start, end) line ranges """
+    merged = []
+    for start, end in sorted(r for r in ranges if r[1] > r[0]):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+class Field(object):
+    def __init__(self, name, x, y, size=DEFAULT_SIZE, font=None, default=''):
+        self.name = name
+        self.x = x
+        self.y = y
+        self.size = size
+        self.font = font
+        self.default = default
+
+    def mask(self, text):
+        return _field_mask(text, self.font, self.size)
+
+@functools.lru_cache(maxsize=256)
+def _field_mask(text, font, size):
+    mask = text_mask(text, font, size)
+    mask.flags.writeable = False
+    return mask
+
+class Template(object):
+    """ Static artwork rendered and encoded once, plus variable fields drawn per label
+
+    render() returns a render_cache.CacheEntry whose raster and stream are exactly
+    what a full render followed by encode_raster_bulk would give.
+    """
+    def __init__(self, spec, base_dir='.', nocomp=False, cache=None):
+        self.spec = spec
+        self.base_dir = base_dir
+        self.nocomp = nocomp
+        self.length = int(spec['length'])
+        self.fields = []
+        self._static = []
+        for element in spec.get('elements', []):
+            if 'field' in element:
+                self.fields.append(Field(element['field'], element.get('x', 0), element.get('y', 0),
+                                         element.get('size', DEFAULT_SIZE), element.get('font'),
+                                         element.get('default', '')))
+            else:
+                self._static.append(element)
+
+        if cache is not None:
+            key = template_key(spec, self._assets(), nocomp)
+            entry = cache.get_or_render(key, self._render_static, nocomp)
+        else:
+            raster = self._render_static()
+            entry = CacheEntry(raster, encode_raster_bulk(raster, nocomp))
+        self.static = entry
+        self._canvas = np.unpackbits(np.frombuffer(entry.raster, dtype=np.uint8)).reshape(self.length, HEAD_DOTS).astype(bool)
+        # Offset of every raster line's frame in the static stream, plus the end
+        self._offsets = [record.offset for record in ptcbp.iter_ops(entry.stream)] + [len(entry.stream)]
+        self._frames = {}
+
+    @classmethod
+    def load(cls, path, nocomp=False, cache=None):
+        with open(path) as f:
+            spec = json.load(f)
+        return cls(spec, os.path.dirname(os.path.abspath(path)), nocomp, cache)
+
+    def _path(self, name):
+        return os.path.join(self.base_dir, name)
+
+    def _assets(self):
+        blobs = []
+        for element in self._static:
+            if 'image' in element:
+                with open(self._path(element['image']), 'rb') as f:
+                    blobs.append(f.read())
+        return b''.join(blobs)
+
+    def _render_static(self):
+        canvas = np.zeros((self.length, HEAD_DOTS), dtype=bool)
+        for element in self._static:
+            x, y = element.get('x', 0), element.get('y', 0)
+            if 'text' in element:
+                _blit(canvas, text_mask(element['text'], element.get('font'), element.get('size', DEFAULT_SIZE)), x, y)
+            elif 'image' in element:
+                with Image.open(self._path(element['image'])) as im:
+                    _blit(canvas, ink_mask(im, element.get('dither', 'threshold')).T, x, y)
+            elif 'box' in element:
+                _box(canvas, *element['box'], width=element.get('width', 1), fill=element.get('fill', False))
+            else:
+                raise ValueError(f'Unknown template element {element}')
+        return np.packbits(canvas, axis=1).tobytes()
+
+    def render(self, values):
+        """ Raster and encoded frames of one label, values maps field names to text """
+        masks = []
+        for field in self.fields:
+            text = str(values.get(field.name) or field.default)
+            if text:
+                masks.append((field.x, field.y, field.mask(text)))
+        spans = _merge([(max(0, x), min(self.length, x + mask.shape[0])) for x, _, mask in masks])
+        if not spans:
+            return self.static
+
+        raster, stream = self.static
+        raster_parts, stream_parts = [], []
+        pos = 0
+        for start, end in spans:
+            block = self._canvas[start:end].copy()
+            for x, y, mask in masks:
+                _blit(block, mask, x - start, y)
+            lines = np.packbits(block, axis=1).tobytes()
+            raster_parts += [raster[pos * 16:start * 16], lines]
+            stream_parts.append(stream[self._offsets[pos]:self._offsets[start]])
+            stream_parts += self._encode_lines(lines)
+            pos = end
+        raster_parts.append(raster[pos * 16:])
+        stream_parts.append(stream[self._offsets[pos]:])
+        return CacheEntry(b''.join(raster_parts), b''.join(stream_parts))
+
+    def _encode_lines(self, lines):
+        frames = self._frames
+        if len(frames) > FRAME_MEMO_SIZE:
+            frames.clear()
+        out = []
+        for i in range(0, len(lines), 16):
+            line = lines[i:i + 16]
+            frame = frames.get(line)
+            if frame is None:
+                frame = frames[line] = encode_raster_bulk(line, self.nocomp)
+            out.append(frame)
+        return out
+
+def preview(entry, path):
+    """ Save a label raster as an image, oriented like the template coordinates """
+    img = Image.frombytes('1', (HEAD_DOTS, len(entry.raster) // 16), entry.raster)
+    ImageOps.invert(img.transpose(Image.TRANSPOSE).convert('L')).save(path)
+
+def parse_args():
+    conf = configparser.ConfigParser()
+    conf.read(os.path.join(os.path.dirname(__file__), "config.ini"))
+
+    p = argparse.ArgumentParser(description='Print labels from a template with variable fields.')
+    p.add_argument('template', help='Template JSON file.')
+    p.add_argument('-b', '--batch', help="CSV or JSON lines file with one column per field ('-' for stdin).")
+    p.add_argument('-f', '--field', help='NAME=VALUE for a single label, can be repeated.', action='append', default=[])
+    p.add_argument('-O', '--spool', help='Write the labels as one chained spool file instead of printing.')
+    p.add_argument('-P', '--preview', help='Save the first label as an image instead of printing.')
+    p.add_argument('-t', '--transport', help='Printer transport spec. Defaults to the address in config.ini.', default=conf.get('printer', 'address', fallback=None))
+    p.add_argument('--tape-width', help='Tape width in mm.', type=int, default=conf.getint('printer', 'tape_width', fallback=12))
+    p.add_argument('-C', '--nocomp', help='Disable compression.', action='store_true')
+    p.add_argument('-a', '--auto-cut', help='Enable auto-cutting.', action='store_true')
+    p.add_argument('-m', '--end-margin', help='End margin (in dots).', default=0, type=int)
+    args = p.parse_args()
+    if args.batch and args.field:
+        p.error('-f fills in a single label, it cannot be combined with -b')
+    # do_batch_job sends through a BufferedSender configured from these
+    args.mtu = args.flush_bytes = transport.DEFAULT_MTU
+    args.flush_lines = None
+    args.flush_at_end = False
+    # Feed after the last label like a single print does
+    args.no_feed = False
+    return args
+
+def main():
+    args = parse_args()
+    template = Template.load(args.template, args.nocomp)
+    rows = read_batch(args.batch) if args.batch else [dict(item.split('=', 1) for item in args.field)]
+
+    start = time.perf_counter()
+    entries = [template.render(row) for row in rows]
+    elapsed = time.perf_counter() - start
+    print(f'=> Rendered {len(entries)} labels in {elapsed:.3f}s ({len(entries) / elapsed:.0f} labels/s)')
+
+    if args.preview:
+        preview(entries[0], args.preview)
+        print(f'=> Saved preview to {args.preview}')
+        return
+    tape_dim = (ptcbp.MediaType.laminated, args.tape_width, 0)
+    if args.spool:
+        index = write_spool(args.spool, entries, tape_dim, not args.nocomp, args.auto_cut, args.end_margin)
+        print(f'=> Wrote {len(index)} pages to {args.spool}')
+        return
+
+    with contextlib.closing(transport.open_transport(args.transport)) as ser:
+        ser.connect()
+        try:
+            do_batch_job(ser, args, entries)
+        finally:
+            reset_printer(ser)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Printer transports
+#
+# Every transport mimics the subset of the socket API the rest of the code uses
+# (connect/send/recv/close), so a BluetoothSocket, a serial device, a TCP socket
+# and the in-process emulator are interchangeable.
+
+import os
+import time
+
+DEFAULT_RFCOMM_CHANNEL = 1
+DEFAULT_TCP_PORT = 9100
+# Largest single write handed to the transport. Fits in one RFCOMM frame with the
+# default BlueZ MTU, so a write never gets fragmented at the L2CAP layer.
+DEFAULT_MTU = 990
+
+class Transport(object):
+    def connect(self) -> None:
+        pass
+
+    def send(self, data: bytes) -> int:
+        raise NotImplementedError()
+
+    def recv(self, size: int) -> bytes:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+class RfcommTransport(Transport):
+    """ Bluetooth RFCOMM through pybluez (PT-P300BT and friends) """
+    def __init__(self, address: str, channel: int=DEFAULT_RFCOMM_CHANNEL) -> None:
+        self.address = address
+        self.channel = channel
+        self.sock = None
+
+    def connect(self) -> None:
+        import bluetooth
+        self.sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        self.sock.connect((self.address, self.channel))
+
+    def send(self, data: bytes) -> int:
+        return self.sock.send(data)
+
+    def recv(self, size: int) -> bytes:
+        return self.sock.recv(size)
+
+    def close(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class SerialTransport(Transport):
+    """ A serial TTY such as a bound /dev/rfcomm0 or a USB CDC device """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.fd = None
+
+    def connect(self) -> None:
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NOCTTY)
+        if os.isatty(self.fd):
+            import tty
+            tty.setraw(self.fd)
+
+    def send(self, data: bytes) -> int:
+        return os.write(self.fd, data)
+
+    def recv(self, size: int) -> bytes:
+        return os.read(self.fd, size)
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class TcpTransport(Transport):
+    """ Raw TCP printing port of network models (e.g. PT-P750W) """
+    def __init__(self, host: str, port: int=DEFAULT_TCP_PORT) -> None:
+        self.host = host
+        self.port = port
+        self.sock = None
+
+    def connect(self) -> None:
+        import socket
+        self.sock = socket.create_connection((self.host, self.port))
+
+    def send(self, data: bytes) -> int:
+        return self.sock.send(data)
+
+    def recv(self, size: int) -> bytes:
+        return self.sock.recv(size)
+
+    def close(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+def send_all(conn, data, mtu: int=DEFAULT_MTU) -> int:
+    """ Send data in writes of at most mtu bytes, retrying short writes. Returns the number of writes. """
+    view = memoryview(data)
+    writes = 0
+    while view:
+        sent = conn.send(view[:mtu])
+        if sent <= 0:
+            raise IOError('Transport refused to send data')
+        view = view[sent:]
+        writes += 1
+    return writes
+
+class FrameBuffer(bytearray):
+    """ Collects frames instead of sending them, e.g. to build a job stream offline """
+    def send(self, data: bytes, lines: int=0) -> int:
+        self.extend(data)
+        return len(data)
+
+class BufferedSender(object):
+    """ Coalesces frames into MTU-sized writes on top of a transport
+
+    Frames passed to send() are buffered and written out in chunks of at most mtu
+    bytes once the flush policy triggers: flush_bytes buffered bytes, or flush_lines
+    raster lines (as counted by the lines argument of send). With both set to None
+    everything is held until flush(), i.e. the end of the job. recv() always flushes
+    first, since the printer can only answer what it has received.
+    """
+    def __init__(self, transport, mtu: int=DEFAULT_MTU, flush_bytes: int=DEFAULT_MTU, flush_lines: int=None) -> None:
+        if mtu <= 0:
+            raise ValueError('mtu must be positive')
+        self.transport = transport
+        self.mtu = mtu
+        self.flush_bytes = flush_bytes
+        self.flush_lines = flush_lines
+        self.bytes_sent = 0
+        self.writes = 0
+        self.flushes = 0
+        # Time spent inside transport writes
+        self.send_seconds = 0.0
+        self._buf = bytearray()
+        self._lines = 0
+
+    def send(self, data: bytes, lines: int=0) -> int:
+        self._buf += data
+        self._lines += lines
+        if self.flush_lines is not None and self._lines >= self.flush_lines:
+            self.flush()
+        elif self.flush_bytes is not None and len(self._buf) >= self.flush_bytes:
+            if self.flush_bytes < self.mtu:
+                self.flush()
+            else:
+                # Only ship whole MTU-sized writes, the tail rides along with later frames
+                self._write(len(self._buf) - len(self._buf) % self.mtu)
+        return len(data)
+
+    def flush(self) -> None:
+        if self._buf:
+            self._write(len(self._buf))
+        self._lines = 0
+
+    def _write(self, size: int) -> None:
+        view = memoryview(self._buf)
+        pos = 0
+        start = time.perf_counter()
+        try:
+            while pos < size:
+                sent = self.transport.send(view[pos:min(pos + self.mtu, size)])
+                if sent <= 0:
+                    raise IOError('Transport refused to send data')
+                # A short write is fine, the remainder goes out with the next one
+                pos += sent
+                self.bytes_sent += sent
+                self.writes += 1
+        finally:
+            self.send_seconds += time.perf_counter() - start
+            view.release()
+            del self._buf[:pos]
+        self.flushes += 1
+
+    def recv(self, size: int) -> bytes:
+        self.flush()
+        return self.transport.recv(size)
+
+def _parse_options(query: str) -> dict:
+    options = {}
+    for item in filter(None, query.split('&')):
+        key, _, value = item.partition('=')
+        options[key.replace('-', '_')] = float(value)
+    return options
+
+def open_transport(spec: str, channel: int=DEFAULT_RFCOMM_CHANNEL) -> Transport:
+    """ Create a transport from a spec string. The transport is not connected yet.
+
+    rfcomm://EC:79:xx:xx:xx:xx[/channel]  Bluetooth RFCOMM (a bare BDADDR also works)
+    serial:///dev/rfcomm0                 Serial device (a bare /dev/... path also works)
+    tcp://host[:port]                     Raw TCP, port 9100 by default
+    emu://[?bandwidth=..&head_speed=..]   In-process printer emulator
+    """
+    scheme, sep, rest = spec.partition('://')
+    if not sep:
+        scheme, rest = ('serial', spec) if spec.startswith('/') else ('rfcomm', spec)
+
+    if scheme == 'rfcomm':
+        address, _, ch = rest.partition('/')
+        return RfcommTransport(address, int(ch) if ch else channel)
+    elif scheme == 'serial':
+        return SerialTransport(rest)
+    elif scheme == 'tcp':
+        host, _, port = rest.partition(':')
+        return TcpTransport(host, int(port) if port else DEFAULT_TCP_PORT)
+    elif scheme == 'emu':
+        from emulator import PrinterEmulator
+        _, _, query = rest.partition('?')
+        return PrinterEmulator(**_parse_options(query))
+    raise ValueError(f'Unknown transport {spec}')